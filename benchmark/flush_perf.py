@@ -0,0 +1,78 @@
+import argparse, sys
+import tornado.ioloop
+import tornado.gen
+import time
+from nats.io.client import Client as NATS
+
+DEFAULT_NUM_FLUSHERS = 500
+DEFAULT_NUM_ROUNDS = 20
+DEFAULT_MSG_SIZE = 16
+
+
+def show_usage():
+    message = """
+Usage: flush_perf [options]
+
+options:
+    -c COUNT                         Concurrent flushers (default: 500)
+    -r ROUNDS                        Flushes by each of them (default: 20)
+    -s SIZE                          Message size (default: 16)
+    -S SUBJECT                       Send subject (default: (test)
+    """
+    print(message)
+
+
+def show_usage_and_die():
+    show_usage()
+    sys.exit(1)
+
+
+@tornado.gen.coroutine
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c', '--count', default=DEFAULT_NUM_FLUSHERS, type=int)
+    parser.add_argument(
+        '-r', '--rounds', default=DEFAULT_NUM_ROUNDS, type=int)
+    parser.add_argument('-s', '--size', default=DEFAULT_MSG_SIZE, type=int)
+    parser.add_argument('-S', '--subject', default='test')
+    parser.add_argument('--servers', default=[], action='append')
+    args = parser.parse_args()
+
+    payload = b'W' * args.size
+    servers = args.servers
+    if len(args.servers) < 1:
+        servers = ["nats://127.0.0.1:4222"]
+
+    nc = NATS()
+    try:
+        yield nc.connect(servers=servers)
+    except Exception, e:
+        sys.stderr.write("ERROR: {0}".format(e))
+        show_usage_and_die()
+
+    # Each flusher publishes a message and waits for it to be
+    # processed by the server before publishing the next one.
+    @tornado.gen.coroutine
+    def flusher():
+        for i in range(0, args.rounds):
+            yield nc.publish(args.subject, payload)
+            yield nc.flush()
+
+    print("Starting {0} concurrent flushers doing {1} flushes each".format(
+        args.count, args.rounds))
+    pongs_received = nc._pongs_received
+    start = time.time()
+    yield [flusher() for i in range(0, args.count)]
+    elapsed = time.time() - start
+
+    flushes = args.count * args.rounds
+    pings = nc._pongs_received - pongs_received
+    print("Test completed : {0:.0f} flushes/sec".format(flushes / elapsed))
+    print("PINGs sent : {0} ({1:.1f} flushes per PING)\n".format(
+        pings, float(flushes) / pings))
+    yield nc.close()
+
+
+if __name__ == '__main__':
+    tornado.ioloop.IOLoop.instance().run_sync(main)
@@ -1,5 +1,6 @@
-import cProfile as prof
+import time
 import tornado.gen
+import tornado.ioloop
 from nats.protocol.parser import *
 
 
@@ -19,24 +20,21 @@ class DummyNatsClient:
             'errors_received': 0
         }
 
-    @tornado.gen.coroutine
     def _send_command(self, cmd):
         pass
 
-    @tornado.gen.coroutine
     def _process_pong(self):
         pass
 
-    @tornado.gen.coroutine
     def _process_ping(self):
         pass
 
-    @tornado.gen.coroutine
-    def _process_msg(self, sid, subject, reply, data):
-        self.stats['in_msgs'] += 1
-        self.stats['in_bytes'] += len(data)
+    def _process_msgs(self, batch):
+        for sid, msgs in batch.items():
+            self.stats['in_msgs'] += len(msgs)
+            for subject, reply, data, chunk in msgs:
+                self.stats['in_bytes'] += len(data)
 
-    @tornado.gen.coroutine
     def _process_err(self, err=None):
         pass
 
@@ -47,39 +45,49 @@ def generate_msg(subject, nbytes, reply=""):
         subject=subject, reply=reply, nbytes=nbytes).encode()
     msg.append(protocol_line)
     msg.append(b'A' * nbytes)
-    msg.append(b'r\n')
+    msg.append(b'\r\n')
     return b''.join(msg)
 
 
-def parse_msgs(max_msgs=1, nbytes=1):
+def parse_msgs(max_msgs=1, nbytes=1, use_regex=False):
     buf = bytearray()
     buf.extend(b''.join(
         [generate_msg("foo", nbytes) for i in range(0, max_msgs)]))
-    print("--- buffer size: {0}".format(len(buf)))
     loop = tornado.ioloop.IOLoop.instance()
-    ps = Parser(DummyNatsClient())
+    ps = Parser(DummyNatsClient(), use_regex=use_regex)
     ps.buf = buf
+    start = time.time()
     loop.run_sync(ps.parse)
-    print("--- stats: ", ps.nc.stats)
+    elapsed = time.time() - start
+    assert ps.nc.stats['in_msgs'] == max_msgs
+    return elapsed
+
+
+def compare(max_msgs=1, nbytes=1):
+    regex = parse_msgs(max_msgs=max_msgs, nbytes=nbytes, use_regex=True)
+    fast = parse_msgs(max_msgs=max_msgs, nbytes=nbytes)
+    print("{0:>8} {1:>8} {2:>14.0f} {3:>14.0f} {4:>7.2f}x".format(
+        max_msgs, nbytes, max_msgs / regex, max_msgs / fast, regex / fast))
 
 
 if __name__ == '__main__':
 
     benchs = [
-        "parse_msgs(max_msgs=10000,   nbytes=1)",
-        "parse_msgs(max_msgs=100000,  nbytes=1)",
-        "parse_msgs(max_msgs=10000,   nbytes=64)",
-        "parse_msgs(max_msgs=100000,  nbytes=64)",
-        "parse_msgs(max_msgs=10000,   nbytes=256)",
-        "parse_msgs(max_msgs=100000,  nbytes=256)",
-        "parse_msgs(max_msgs=10000,   nbytes=1024)",
-        "parse_msgs(max_msgs=100000,  nbytes=1024)",
-        "parse_msgs(max_msgs=10000,   nbytes=8192)",
-        "parse_msgs(max_msgs=100000,  nbytes=8192)",
-        "parse_msgs(max_msgs=10000,   nbytes=16384)",
-        "parse_msgs(max_msgs=100000,  nbytes=16384)",
+        (10000, 1),
+        (100000, 1),
+        (10000, 64),
+        (100000, 64),
+        (10000, 256),
+        (100000, 256),
+        (10000, 1024),
+        (100000, 1024),
+        (10000, 8192),
+        (100000, 8192),
+        (10000, 16384),
+        (100000, 16384),
     ]
 
-    for bench in benchs:
-        print("=== {0}".format(bench))
-        prof.run(bench)
+    print("{0:>8} {1:>8} {2:>14} {3:>14} {4:>8}".format(
+        "msgs", "bytes", "regex msgs/sec", "fast msgs/sec", "speedup"))
+    for max_msgs, nbytes in benchs:
+        compare(max_msgs=max_msgs, nbytes=nbytes)
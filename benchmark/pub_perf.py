@@ -1,4 +1,5 @@
 import argparse, sys
+import resource
 import tornado.ioloop
 import tornado.gen
 import time
@@ -21,6 +22,11 @@ options:
     -s SIZE                          Message size (default: 16)
     -S SUBJECT                       Send subject (default: (test)
     -b BATCH                         Batch size (default: (100)
+    --many                           Send each batch with publish_many
+    --nowait                         Send with publish_nowait
+    --prepared                       Publish on a prepared subject
+    --linger SECONDS                 Flush linger (default: 0)
+    --max-batch BYTES                Flush max batch bytes (default: 1MB)
     """
     print(message)
 
@@ -37,6 +43,11 @@ def main():
     parser.add_argument('-s', '--size', default=DEFAULT_MSG_SIZE, type=int)
     parser.add_argument('-S', '--subject', default='test')
     parser.add_argument('-b', '--batch', default=DEFAULT_BATCH_SIZE, type=int)
+    parser.add_argument('--many', default=False, action='store_true')
+    parser.add_argument('--nowait', default=False, action='store_true')
+    parser.add_argument('--prepared', default=False, action='store_true')
+    parser.add_argument('--linger', default=0, type=float)
+    parser.add_argument('--max-batch', default=1024 * 1024, type=int)
     parser.add_argument('--servers', default=[], action='append')
     args = parser.parse_args()
 
@@ -48,7 +59,11 @@ def main():
     servers = args.servers
     if len(args.servers) < 1:
         servers = ["nats://127.0.0.1:4222"]
-    opts = {"servers": servers}
+    opts = {
+        "servers": servers,
+        "flush_linger": args.linger,
+        "flush_max_batch_bytes": args.max_batch,
+    }
 
     # Make sure we're connected to a server first..
     nc = NATS()
@@ -58,16 +73,44 @@ def main():
         sys.stderr.write("ERROR: {0}".format(e))
         show_usage_and_die()
 
+    subject = args.subject
+    if args.prepared:
+        subject = nc.prepare(args.subject)
+
     # Start the benchmark
     start = time.time()
     to_send = args.count
 
     print("Sending {0} messages of size {1} bytes on [{2}]".format(
         args.count, args.size, args.subject))
+    while to_send > 0 and args.many:
+        batch = min(args.batch, to_send)
+        yield nc.publish_many([(subject, payload)] * batch)
+        if (to_send % HASH_MODULO) < batch:
+            sys.stdout.write("#")
+            sys.stdout.flush()
+        to_send -= batch
+
+        # Minimal pause in between batches sent to server
+        yield tornado.gen.sleep(0.00001)
+
+    while to_send > 0 and args.nowait:
+        for i in range(0, args.batch):
+            to_send -= 1
+            nc.publish_nowait(subject, payload)
+            if (to_send % HASH_MODULO) == 0:
+                sys.stdout.write("#")
+                sys.stdout.flush()
+            if to_send == 0:
+                break
+
+        # Minimal pause in between batches sent to server
+        yield tornado.gen.sleep(0.00001)
+
     while to_send > 0:
         for i in range(0, args.batch):
             to_send -= 1
-            yield nc.publish(args.subject, payload)
+            yield nc.publish(subject, payload)
             if (to_send % HASH_MODULO) == 0:
                 sys.stdout.write("#")
                 sys.stdout.flush()
@@ -84,6 +127,8 @@ def main():
     mbytes = "%.1f" % (((args.size * args.count) / elapsed) / (1024 * 1024))
     print("\nTest completed : {0} msgs/sec ({1}) MB/sec\n".format(
         args.count / elapsed, mbytes))
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print("Peak RSS : {0} MB\n".format(rss))
     yield nc.close()
 
 
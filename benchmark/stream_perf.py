@@ -0,0 +1,95 @@
+import hashlib
+import time
+import tornado.gen
+import tornado.ioloop
+from nats.protocol.parser import *
+
+READ_CHUNK_SIZE = 32768 * 2
+
+
+class DummyNatsClient:
+    def __init__(self):
+        self.in_msgs = 0
+        self.hashes = []
+        self.hash = None
+
+    def _process_msgs(self, batch):
+        for sid, msgs in batch.items():
+            for subject, reply, data, chunk in msgs:
+                self.in_msgs += 1
+                self.hashes.append(hashlib.sha1(data).hexdigest())
+
+    def _process_stream_start(self, sid, subject, reply, size):
+        self.hash = hashlib.sha1()
+
+    def _process_stream_data(self, data):
+        self.hash.update(data)
+
+    def _process_stream_end(self):
+        self.in_msgs += 1
+        self.hashes.append(self.hash.hexdigest())
+
+
+def generate_msg(subject, nbytes, reply=""):
+    msg = []
+    protocol_line = "MSG {subject} 1 {reply} {nbytes}\r\n".format(
+        subject=subject, reply=reply, nbytes=nbytes).encode()
+    msg.append(protocol_line)
+    msg.append(b'A' * nbytes)
+    msg.append(b'\r\n')
+    return b''.join(msg)
+
+
+def parse_msgs(max_msgs=1, nbytes=1, stream=False):
+    nc = DummyNatsClient()
+    ps = Parser(nc)
+    if stream:
+        ps.streams.add(1)
+
+    # Feed the parser in chunks of the size that the client reads.
+    data = generate_msg("foo", nbytes) * max_msgs
+    chunks = [
+        data[i:i + READ_CHUNK_SIZE]
+        for i in range(0, len(data), READ_CHUNK_SIZE)
+    ]
+    peak = [0]
+
+    @tornado.gen.coroutine
+    def feed():
+        for chunk in chunks:
+            yield ps.parse(chunk)
+            peak[0] = max(peak[0], len(ps.buf))
+
+    loop = tornado.ioloop.IOLoop.instance()
+    start = time.time()
+    loop.run_sync(feed)
+    elapsed = time.time() - start
+    assert nc.in_msgs == max_msgs
+    return elapsed, peak[0]
+
+
+def compare(max_msgs=1, nbytes=1):
+    total = float(max_msgs * nbytes) / (1024 * 1024)
+    copy, copy_peak = parse_msgs(max_msgs=max_msgs, nbytes=nbytes)
+    stream, stream_peak = parse_msgs(
+        max_msgs=max_msgs, nbytes=nbytes, stream=True)
+    print("{0:>8} {1:>8} {2:>12.1f} {3:>14.1f} {4:>14} {5:>16}".format(
+        max_msgs, nbytes, total / copy, total / stream, copy_peak,
+        stream_peak))
+
+
+if __name__ == '__main__':
+
+    benchs = [
+        (2000, 16384),
+        (1000, 65536),
+        (500, 262144),
+        (200, 524288),
+        (100, 1048576),
+    ]
+
+    print("{0:>8} {1:>8} {2:>12} {3:>14} {4:>14} {5:>16}".format(
+        "msgs", "bytes", "copy MB/sec", "stream MB/sec", "copy peak buf",
+        "stream peak buf"))
+    for max_msgs, nbytes in benchs:
+        compare(max_msgs=max_msgs, nbytes=nbytes)
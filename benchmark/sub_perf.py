@@ -30,6 +30,8 @@ def show_usage_and_die():
 
 global received
 received = 0
+global start
+start = None
 
 
 @tornado.gen.coroutine
@@ -57,6 +59,7 @@ def main():
     @tornado.gen.coroutine
     def handler(msg):
         global received
+        global start
         received += 1
         # Measure time from when we get the first message.
         if received == 1:
@@ -70,14 +73,10 @@ def main():
     elif args.subtype == 'async':
         yield nc.subscribe_async(args.subject, cb=handler)
     else:
-        sys.stderr.write(
-            "ERROR: Unsupported type of subscription {0}".format(e))
+        sys.stderr.write("ERROR: Unsupported type of subscription {0}".format(
+            args.subtype))
         show_usage_and_die()
 
-    # Start the benchmark
-    start = time.time()
-    to_send = args.count
-
     print("Waiting for {0} messages on [{1}]...".format(
         args.count, args.subject))
     while received < args.count:
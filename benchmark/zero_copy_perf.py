@@ -0,0 +1,88 @@
+import time
+import tornado.gen
+import tornado.ioloop
+from nats.protocol.parser import *
+
+READ_CHUNK_SIZE = 32768 * 2
+
+# Runs of each mode, of which the fastest one is taken.
+REPEAT = 5
+
+
+class DummyNatsClient:
+    def __init__(self):
+        self.in_msgs = 0
+        self.in_bytes = 0
+
+    def _process_msgs(self, batch):
+        for sid, msgs in batch.items():
+            self.in_msgs += len(msgs)
+            for subject, reply, data, chunk in msgs:
+                self.in_bytes += len(data)
+
+                # Handler is done with the message so give back the buffer.
+                if chunk is not None:
+                    self.pool.release(chunk)
+
+
+def generate_msg(subject, nbytes, reply=""):
+    msg = []
+    protocol_line = "MSG {subject} 1 {reply} {nbytes}\r\n".format(
+        subject=subject, reply=reply, nbytes=nbytes).encode()
+    msg.append(protocol_line)
+    msg.append(b'A' * nbytes)
+    msg.append(b'\r\n')
+    return b''.join(msg)
+
+
+def parse_msgs(max_msgs=1, nbytes=1, zero_copy=False):
+    nc = DummyNatsClient()
+    nc.pool = ChunkPool() if zero_copy else None
+    ps = Parser(nc, pool=nc.pool)
+
+    # Feed the parser in chunks of the size that the client reads.
+    data = generate_msg("foo", nbytes) * max_msgs
+    chunks = [
+        data[i:i + READ_CHUNK_SIZE]
+        for i in range(0, len(data), READ_CHUNK_SIZE)
+    ]
+
+    @tornado.gen.coroutine
+    def feed():
+        for chunk in chunks:
+            yield ps.parse(chunk)
+
+    loop = tornado.ioloop.IOLoop.instance()
+    start = time.time()
+    loop.run_sync(feed)
+    elapsed = time.time() - start
+    assert nc.in_msgs == max_msgs
+    return elapsed
+
+
+def compare(max_msgs=1, nbytes=1):
+    total = float(max_msgs * nbytes) / (1024 * 1024)
+    copy = min(
+        parse_msgs(max_msgs=max_msgs, nbytes=nbytes) for _ in range(REPEAT))
+    zero_copy = min(
+        parse_msgs(max_msgs=max_msgs, nbytes=nbytes, zero_copy=True)
+        for _ in range(REPEAT))
+    print("{0:>8} {1:>8} {2:>12.1f} {3:>16.1f} {4:>7.2f}x".format(
+        max_msgs, nbytes, total / copy, total / zero_copy, copy / zero_copy))
+
+
+if __name__ == '__main__':
+
+    benchs = [
+        (10000, 1024),
+        (2000, 16384),
+        (1000, 65536),
+        (500, 262144),
+        (200, 524288),
+        (100, 1048576),
+    ]
+
+    print("{0:>8} {1:>8} {2:>12} {3:>16} {4:>8}".format(
+        "msgs", "bytes", "copy MB/sec", "zero copy MB/sec", "speedup"))
+    for max_msgs, nbytes in benchs:
+        compare(max_msgs=max_msgs, nbytes=nbytes)
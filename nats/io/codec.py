@@ -0,0 +1,64 @@
+# Copyright 2015-2018 The NATS Authors
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import zlib
+
+# Payloads encoded by a codec start with the prefix and a byte
+# telling how they were encoded.
+CODEC_PREFIX = b'\x00NZ'
+CODEC_PREFIX_SIZE = len(CODEC_PREFIX) + 1
+CODEC_RAW = b'\x00'
+CODEC_ZLIB = b'\x01'
+
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+DEFAULT_COMPRESSION_LEVEL = 6
+
+
+class ZlibCodec(object):
+    """
+    ZlibCodec compresses with zlib the payloads which are at least
+    `threshold' bytes and marks them with a framing prefix, so that
+    the subscriptions using the codec decompress them transparently.
+
+    Smaller payloads and the ones which do not get smaller are sent
+    as they are, and only those which happen to start like the prefix
+    are framed as raw so that they are not mistaken for compressed.
+    """
+
+    def __init__(self,
+                 threshold=DEFAULT_COMPRESSION_THRESHOLD,
+                 level=DEFAULT_COMPRESSION_LEVEL):
+        self.threshold = threshold
+        self.level = level
+
+    def encode(self, payload):
+        if len(payload) >= self.threshold:
+            if not isinstance(payload, bytes):
+                payload = bytes(payload)
+            data = zlib.compress(payload, self.level)
+            if len(data) + CODEC_PREFIX_SIZE < len(payload):
+                return b''.join([CODEC_PREFIX, CODEC_ZLIB, data])
+        if payload[:len(CODEC_PREFIX)] == CODEC_PREFIX:
+            return b''.join([CODEC_PREFIX, CODEC_RAW, bytes(payload)])
+        return payload
+
+    def decode(self, payload):
+        if payload[:len(CODEC_PREFIX)] != CODEC_PREFIX:
+            return payload
+        kind = payload[len(CODEC_PREFIX):CODEC_PREFIX_SIZE]
+        if isinstance(payload, memoryview):
+            payload = payload.tobytes()
+        if kind == CODEC_ZLIB:
+            return zlib.decompress(payload[CODEC_PREFIX_SIZE:])
+        return payload[CODEC_PREFIX_SIZE:]
@@ -30,6 +30,10 @@ class ErrConnectionClosed(NatsError):
     pass
 
 
+class ErrConnectionDraining(NatsError):
+    pass
+
+
 class ErrSecureConnRequired(NatsError):
     pass
 
@@ -64,6 +68,23 @@ class ErrMaxPayload(NatsError):
     pass
 
 
+class ErrBackpressure(NatsError):
+    """
+    Raised when publishing without waiting while the pending data
+    which has not been written to the server yet is above the high
+    watermark.
+    """
+    pass
+
+
+class ErrReconnectBufExceeded(NatsError):
+    """
+    Raised when publishing while reconnecting and the message does
+    not fit in the reconnect buffer.
+    """
+    pass
+
+
 class ErrNoServers(NatsError):
     """
     Raised when the number of reconnect attempts is exhausted
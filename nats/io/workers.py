@@ -0,0 +1,283 @@
+# Copyright 2015-2018 The NATS Authors
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import mmap
+import multiprocessing
+import os
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+from collections import deque
+from nats.io.client import Msg
+from nats.io.errors import *
+
+DEFAULT_RING_SIZE = 4 * 1024 * 1024
+
+# Kept low enough that the requests to a worker always fit in the
+# pipe, so that sending them never blocks the loop.
+DEFAULT_WORKER_IN_FLIGHT = 128
+
+_REGISTER = 0
+_MSG = 1
+
+
+class ProcessPool(object):
+    """
+    ProcessPool calls the callbacks of subscriptions in a number of
+    worker processes.  Each worker has a ring buffer in memory shared
+    with the client, where the payloads are written for it, so that
+    only the subject, reply and the position of the payload have to
+    be sent to the worker through a pipe.
+
+    Messages are handled by each worker one at a time and in the order
+    they were handed to it, and up to `max_in_flight' of them can be
+    waiting for it.  Callbacks have to be module level functions, and
+    what they return or raise is sent back to the client.
+
+      pool = ProcessPool(workers=4)
+      yield nc.subscribe("work", cb=decode, process_pool=pool)
+
+    The workers are forked once the pool is used by a subscription and
+    stop once the pool is closed.
+    """
+
+    def __init__(self,
+                 workers=None,
+                 ring_size=DEFAULT_RING_SIZE,
+                 max_in_flight=DEFAULT_WORKER_IN_FLIGHT):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.ring_size = ring_size
+        self.max_in_flight = max_in_flight
+        self._loop = None
+        self._ring = None
+        self._workers = []
+        self._handlers = {}
+
+    def __len__(self):
+        return self.workers
+
+    def start(self, io_loop):
+        if self._ring is not None:
+            return
+        self._loop = io_loop
+        self._ring = mmap.mmap(-1, self.ring_size * self.workers)
+        for i in range(self.workers):
+            worker = _Worker(self._ring, i * self.ring_size, self.ring_size)
+            worker.start(self._handlers)
+            self._loop.add_handler(worker.results.fileno(),
+                                   self._results_handler(worker),
+                                   tornado.ioloop.IOLoop.READ)
+            self._workers.append(worker)
+
+    def register(self, sid, cb):
+        """
+        Makes the callback of a subscription known to the workers.
+        """
+        self._handlers[sid] = cb
+        for worker in self._workers:
+            worker.requests.send((_REGISTER, sid, cb))
+
+    @tornado.gen.coroutine
+    def submit(self, shard, msg):
+        """
+        Hands a message to the worker for the shard once there is room
+        for it, and returns a future for what the callback returns.
+        """
+        if self._ring is None:
+            raise ErrConnectionClosed
+        data = msg.data
+        size = len(data)
+        if size > self.ring_size:
+            raise ErrMaxPayload
+        worker = self._workers[shard % self.workers]
+        while True:
+            offset = None
+            if len(worker.inflight) < self.max_in_flight:
+                offset = worker.alloc(size)
+            if offset is not None:
+                break
+            if worker.space is None:
+                worker.space = tornado.concurrent.Future()
+            yield worker.space
+            if self._ring is None:
+                raise ErrConnectionClosed
+
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        start = worker.base + offset
+        self._ring[start:start + size] = data
+        future = tornado.concurrent.Future()
+        worker.inflight.append((offset, offset + size, future))
+        worker.requests.send((_MSG, msg.sid, msg.subject, msg.reply, offset,
+                              size))
+        raise tornado.gen.Return(future)
+
+    def _results_handler(self, worker):
+        def handle_results(fd, events):
+            try:
+                while worker.results.poll():
+                    ok, value = worker.results.recv()
+                    future = worker.release()
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+            except (EOFError, IOError):
+                # The worker is gone along with the messages it had.
+                self._loop.remove_handler(fd)
+                worker.fail(NatsError("nats: worker process exited"))
+            worker.wake()
+
+        return handle_results
+
+    def close(self):
+        """
+        Stops the workers, failing the messages which were waiting.
+        """
+        if self._ring is None:
+            return
+        for worker in self._workers:
+            self._loop.remove_handler(worker.results.fileno())
+            worker.stop()
+            worker.fail(ErrConnectionClosed())
+            worker.wake()
+        self._workers = []
+        self._ring.close()
+        self._ring = None
+
+
+class _Worker(object):
+    """
+    _Worker keeps the state of a worker process and of its ring
+    buffer, which is freed in the same order it is allocated.
+    """
+
+    def __init__(self, ring, base, size):
+        self.ring = ring
+        self.base = base
+        self.size = size
+        self.process = None
+        self.requests = None
+        self.results = None
+        self.inflight = deque()
+        # How many of the messages in flight are left before the ring
+        # wrapped around, since offsets alone cannot tell for empty ones.
+        self.wrapped = 0
+        self.space = None
+
+    def start(self, handlers):
+        requests, self.requests = multiprocessing.Pipe(duplex=False)
+        self.results, results = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+            target=_run_worker,
+            args=(self.ring, self.base, handlers, requests, results))
+        self.process.daemon = True
+        self.process.start()
+        requests.close()
+        results.close()
+
+    def alloc(self, size):
+        """
+        Returns the offset of the next free space for size bytes,
+        or None in case there is not enough of it yet.  The space is
+        taken by the message appended next to inflight.
+        """
+        inflight = self.inflight
+        if not inflight:
+            return 0
+        head = inflight[0][0]
+        tail = inflight[-1][1]
+        if self.wrapped:
+            # Wrapped around, free space is up to the oldest one.
+            if tail + size <= head:
+                return tail
+        elif tail + size <= self.size:
+            return tail
+        elif size <= head:
+            self.wrapped = len(inflight)
+            return 0
+        return None
+
+    def release(self):
+        """
+        Frees the space of the oldest message and returns its future.
+        """
+        _, _, future = self.inflight.popleft()
+        if self.wrapped:
+            self.wrapped -= 1
+        return future
+
+    def wake(self):
+        space, self.space = self.space, None
+        if space is not None:
+            space.set_result(True)
+
+    def fail(self, err):
+        inflight, self.inflight = self.inflight, deque()
+        self.wrapped = 0
+        for _, _, future in inflight:
+            future.set_exception(err)
+
+    def stop(self):
+        try:
+            self.requests.send(None)
+        except IOError:
+            pass
+        self.process.join()
+        self.requests.close()
+        self.results.close()
+
+
+def _close_inherited_fds(keep):
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = range(3, os.sysconf('SC_OPEN_MAX'))
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def _run_worker(ring, base, handlers, requests, results):
+    # The worker is forked from a running client, so it would otherwise
+    # keep its socket, its IOLoop and the pipes of the other workers open.
+    _close_inherited_fds((requests.fileno(), results.fileno()))
+    handlers = dict(handlers)
+    while True:
+        req = requests.recv()
+        if req is None:
+            break
+        if req[0] == _REGISTER:
+            handlers[req[1]] = req[2]
+            continue
+
+        _, sid, subject, reply, offset, size = req
+        start = base + offset
+        msg = Msg(
+            subject=subject, reply=reply, data=ring[start:start + size], sid=sid)
+        try:
+            result = (True, handlers[sid](msg))
+        except Exception as e:
+            result = (False, e)
+        try:
+            results.send(result)
+        except Exception as e:
+            # What the callback returned or raised could not be pickled.
+            results.send((False, NatsError("nats: {0!r}".format(e))))
@@ -18,13 +18,15 @@ NATS network protocol parser.
 import re
 import tornado.gen
 
+from tornado.concurrent import is_future
+
 MSG_RE = re.compile(
-    b'\AMSG\s+([^\s]+)\s+([^\s]+)\s+(([^\s]+)[^\S\r\n]+)?(\d+)\r\n')
-OK_RE = re.compile(b'\A\+OK\s*\r\n')
-ERR_RE = re.compile(b'\A-ERR\s+(\'.+\')?\r\n')
-PING_RE = re.compile(b'\APING\s*\r\n')
-PONG_RE = re.compile(b'\APONG\s*\r\n')
-INFO_RE = re.compile(b'\AINFO\s+([^\r\n]+)\r\n')
+    b'MSG\s+([^\s]+)\s+([^\s]+)\s+(([^\s]+)[^\S\r\n]+)?(\d+)\r\n')
+OK_RE = re.compile(b'\+OK\s*\r\n')
+ERR_RE = re.compile(b'-ERR\s+(\'.+\')?\r\n')
+PING_RE = re.compile(b'PING\s*\r\n')
+PONG_RE = re.compile(b'PONG\s*\r\n')
+INFO_RE = re.compile(b'INFO\s+([^\r\n]+)\r\n')
 
 INFO_OP = b'INFO'
 CONNECT_OP = b'CONNECT'
@@ -49,16 +51,56 @@ PING_SIZE = len(PING)
 PONG_SIZE = len(PONG)
 MSG_OP_SIZE = len(MSG_OP)
 ERR_OP_SIZE = len(ERR_OP)
+INFO_OP_SIZE = len(INFO_OP)
+
+# First byte of each one of the ops sent by the server.
+_M_ = ord('M')
+_P_ = ord('P')
+_I_ = ord('I')
+_PLUS_ = ord('+')
+_MINUS_ = ord('-')
+
+MSG_OP_PREFIXES = (MSG_OP + _SPC_, MSG_OP + b'\t')
+ERR_OP_PREFIXES = (ERR_OP + _SPC_, ERR_OP + b'\t')
+INFO_OP_PREFIXES = (INFO_OP + _SPC_, INFO_OP + b'\t')
 
 # States
 AWAITING_CONTROL_LINE = 1
 AWAITING_MSG_PAYLOAD = 2
+STREAMING_MSG_PAYLOAD = 3
 MAX_CONTROL_LINE_SIZE = 1024
 
+# Pooled payload chunks
+MIN_CHUNK_SIZE = 256
+DEFAULT_POOL_MAX_FREE_CHUNKS = 16
+
 
 class Parser(object):
-    def __init__(self, nc=None):
+    """
+    Parser for the NATS wire protocol.
+
+    By default control lines are handled by a hand written state
+    machine which dispatches on the first byte of the op and scans
+    for the CRLF only once.  Passing `use_regex=True` switches to the
+    regular expression based matching, which is kept as a reference
+    implementation of the protocol.
+
+    Payloads of messages for the sids in `streams` are not gathered
+    in the buffer, instead they are handed to the client in pieces as
+    they arrive, in between calls to start and end the message.
+    """
+
+    def __init__(self, nc=None, use_regex=False, pool=None):
         self.nc = nc
+        self.use_regex = use_regex
+
+        # When set, payloads are copied into chunks taken from
+        # the pool and dispatched as read-only memoryviews.
+        self.pool = pool
+
+        # Sids of the subscriptions which stream their messages,
+        # these are kept across reconnects.
+        self.streams = set()
         self.reset()
 
     def __repr__(self):
@@ -66,92 +108,353 @@ class Parser(object):
 
     def reset(self):
         self.buf = bytearray()
+        self.pos = 0
         self.state = AWAITING_CONTROL_LINE
         self.needed = 0
         self.msg_arg = {}
+        self.chunk = None
+        self.filled = 0
+        self.waiting = None
+        self.batch = {}
 
-    @tornado.gen.coroutine
     def parse(self, data=b''):
         """
         Parses the wire protocol from NATS for the client
         and dispatches the subscription callbacks.
+
+        Consumed bytes are skipped by advancing the read position,
+        and the buffer is compacted only once the chunk has been
+        processed, so the remaining bytes are not shifted per op.
+
+        Messages are collected and dispatched as a batch once the
+        chunk has been parsed, or before any other op which follows
+        them.
+
+        Ops are dispatched synchronously, and only in case one of
+        the callbacks returns a future which has not completed yet
+        does the parsing continue in a coroutine once it is done,
+        returning a future for it.
         """
+        if self.chunk is not None and self.pos == len(self.buf):
+            # Nothing else buffered so can copy straight into the chunk.
+            n = self._fill_chunk(data, 0)
+            data = buffer(data, n)
+        elif (self.state == STREAMING_MSG_PAYLOAD and self.waiting is None
+              and self.pos == len(self.buf)):
+            # Nothing else buffered so can hand the data straight over.
+            n = min(len(data), self.needed - self.filled)
+            if n > 0:
+                self.filled += n
+                result = self.nc._process_stream_data(data[:n])
+                data = buffer(data, n)
+                if _is_pending(result):
+                    self.buf.extend(data)
+                    return self._wait(result)
         self.buf.extend(data)
-        while self.buf:
+
+        # Bytes will be parsed after the pending callback is done.
+        if self.waiting is not None:
+            return self.waiting
+        return self._parse()
+
+    def _parse(self):
+        while self.pos < len(self.buf):
+            result = None
             if self.state == AWAITING_CONTROL_LINE:
-                msg = MSG_RE.match(self.buf)
-                if msg:
-                    try:
-                        subject, sid, _, reply, needed_bytes = msg.groups()
-                        self.msg_arg["subject"] = subject
-                        self.msg_arg["sid"] = int(sid)
-                        if reply:
-                            self.msg_arg["reply"] = reply
-                        else:
-                            self.msg_arg["reply"] = b''
-                        self.needed = int(needed_bytes)
-                        del self.buf[:msg.end()]
-                        self.state = AWAITING_MSG_PAYLOAD
-                        continue
-                    except:
-                        raise ErrProtocol("nats: malformed MSG")
-
-                ok = OK_RE.match(self.buf)
-                if ok:
-                    # Do nothing and just skip.
-                    del self.buf[:ok.end()]
-                    continue
-
-                err = ERR_RE.match(self.buf)
-                if err:
-                    err_msg = err.groups()
-                    yield self.nc._process_err(err_msg)
-                    del self.buf[:err.end()]
-                    continue
-
-                ping = PING_RE.match(self.buf)
-                if ping:
-                    del self.buf[:ping.end()]
-                    yield self.nc._process_ping()
-                    continue
-
-                pong = PONG_RE.match(self.buf)
-                if pong:
-                    del self.buf[:pong.end()]
-                    yield self.nc._process_pong()
-                    continue
-
-                info = INFO_RE.match(self.buf)
-                if info:
-                    info_line = info.groups()[0]
-                    self.nc._process_info(info_line)
-                    del self.buf[:info.end()]
-                    continue
-
-                # If nothing matched at this point, then probably
-                # a split buffer and need to gather more bytes,
-                # otherwise it would mean that there is an issue
-                # and we're getting malformed control lines.
-                if len(self.buf
-                       ) < MAX_CONTROL_LINE_SIZE and _CRLF_ not in self.buf:
-                    break
+                if self.use_regex:
+                    line = self._match_control_line()
                 else:
-                    raise ErrProtocol("nats: unknown protocol")
+                    line = self._scan_control_line()
+
+                # Probably a split buffer so need to gather more bytes.
+                if line is None:
+                    break
+
+                op, arg, end = line
+                if op != MSG_OP and self.batch:
+                    # Messages which came before the op have to be
+                    # dispatched first, in case of having to wait
+                    # for them the op will be parsed again after.
+                    result = self._dispatch_batch()
+                    if _is_pending(result):
+                        return self._wait(result)
+
+                self.pos = end
+                if op == MSG_OP:
+                    msg_arg = self.msg_arg
+                    if msg_arg["sid"] in self.streams:
+                        self.state = STREAMING_MSG_PAYLOAD
+                        self.filled = 0
+                        result = self.nc._process_stream_start(
+                            msg_arg["sid"], msg_arg["subject"],
+                            msg_arg["reply"], self.needed)
+                    else:
+                        self.state = AWAITING_MSG_PAYLOAD
+                elif op == PING_OP:
+                    result = self.nc._process_ping()
+                elif op == PONG_OP:
+                    result = self.nc._process_pong()
+                elif op == ERR_OP:
+                    result = self.nc._process_err(arg)
+                elif op == INFO_OP:
+                    self.nc._process_info(arg)
 
             elif self.state == AWAITING_MSG_PAYLOAD:
-                if len(self.buf) >= self.needed + CRLF_SIZE:
-                    subject = self.msg_arg["subject"]
-                    sid = self.msg_arg["sid"]
-                    reply = self.msg_arg["reply"]
-
-                    # Consume msg payload from buffer and set next parser state.
-                    payload = bytes(self.buf[:self.needed])
-                    del self.buf[:self.needed + CRLF_SIZE]
+                start = self.pos
+                end = start + self.needed
+                if self.pool is None:
+                    if len(self.buf) < end + CRLF_SIZE:
+                        # Wait until we have enough bytes in buffer.
+                        break
+                    chunk = None
+                    payload = bytes(self.buf[start:end])
+                    self.pos = end + CRLF_SIZE
+                elif self.chunk is None and len(self.buf) >= end + CRLF_SIZE:
+                    # Whole payload is buffered so copy it in one go.
+                    chunk = self.pool.acquire(self.needed)
+                    chunk[:self.needed] = buffer(self.buf, start, self.needed)
+                    payload = memoryview(buffer(chunk, 0, self.needed))
+                    self.pos = end + CRLF_SIZE
+                else:
+                    # Payload spans reads, so it is copied into the chunk
+                    # as it arrives instead of being buffered first.
+                    if self.chunk is None:
+                        self.chunk = self.pool.acquire(self.needed)
+                        self.filled = 0
+                    self.pos += self._fill_chunk(self.buf, self.pos)
+                    if self.filled < self.needed or len(
+                            self.buf) - self.pos < CRLF_SIZE:
+                        break
+                    chunk = self.chunk
+                    payload = memoryview(buffer(chunk, 0, self.needed))
+                    self.chunk = None
+                    self.pos += CRLF_SIZE
+
+                # Consumed msg payload so add it to the batch of messages
+                # for its subscription and set next parser state.
+                self.state = AWAITING_CONTROL_LINE
+                msg_arg = self.msg_arg
+                sid = msg_arg["sid"]
+                msgs = self.batch.get(sid)
+                if msgs is None:
+                    msgs = self.batch[sid] = []
+                msgs.append((msg_arg["subject"], msg_arg["reply"], payload,
+                             chunk))
+
+            elif self.state == STREAMING_MSG_PAYLOAD:
+                n = min(len(self.buf) - self.pos, self.needed - self.filled)
+                if n > 0:
+                    start = self.pos
+                    self.pos += n
+                    self.filled += n
+                    result = self.nc._process_stream_data(
+                        bytes(self.buf[start:self.pos]))
+                else:
+                    if len(self.buf) - self.pos < CRLF_SIZE:
+                        break
+                    self.pos += CRLF_SIZE
                     self.state = AWAITING_CONTROL_LINE
-                    yield self.nc._process_msg(sid, subject, reply, payload)
+                    result = self.nc._process_stream_end()
+
+            if _is_pending(result):
+                return self._wait(result)
+
+        # Dispatch all the messages which were parsed from the chunk.
+        if self.batch:
+            result = self._dispatch_batch()
+            if _is_pending(result):
+                return self._wait(result)
+        self._compact()
+
+    def _dispatch_batch(self):
+        """
+        Hands the messages collected so far to the client,
+        grouped by the sid of their subscription.
+        """
+        batch, self.batch = self.batch, {}
+        return self.nc._process_msgs(batch)
+
+    def _wait(self, future):
+        self.waiting = self._resume(future)
+        return self.waiting
+
+    @tornado.gen.coroutine
+    def _resume(self, future):
+        """
+        Waits for the callback which returned the future to be done
+        before continuing with the rest of the buffered bytes.
+        """
+        try:
+            yield future
+        finally:
+            self.waiting = None
+        result = self._parse()
+        if result is not None:
+            yield result
+
+    def _fill_chunk(self, data, start):
+        """
+        Copies as much of the pending payload as available
+        from data into the chunk, returning the number of bytes.
+        """
+        n = min(len(data) - start, self.needed - self.filled)
+        if n > 0:
+            self.chunk[self.filled:self.filled + n] = buffer(data, start, n)
+            self.filled += n
+        return n
+
+    def _compact(self):
+        """
+        Drops the bytes which have already been consumed from the
+        buffer, leaving only a partial op at the start of it.
+        """
+        if self.pos > 0:
+            del self.buf[:self.pos]
+            self.pos = 0
+
+    def _scan_control_line(self):
+        """
+        Finds the end of the next control line and dispatches on its
+        first byte, returning a tuple with the op, its argument and
+        the position right after the line, or None in case the
+        control line has not been fully received yet.
+        """
+        buf = self.buf
+        pos = self.pos
+        end = buf.find(_CRLF_, pos)
+        if end < 0:
+            if len(buf) - pos < MAX_CONTROL_LINE_SIZE:
+                return None
+            raise ErrProtocol("nats: unknown protocol")
+
+        c = buf[pos]
+        if c == _M_:
+            if buf.startswith(MSG_OP_PREFIXES, pos):
+                # MSG <subject> <sid> [reply] <size>
+                args = bytes(buf[pos + MSG_OP_SIZE + 1:end]).split()
+                nargs = len(args)
+                if nargs == 3:
+                    subject, sid, needed_bytes = args
+                    reply = b''
+                elif nargs == 4:
+                    subject, sid, reply, needed_bytes = args
                 else:
-                    # Wait until we have enough bytes in buffer.
-                    break
+                    raise ErrProtocol("nats: malformed MSG")
+                try:
+                    self.msg_arg = {
+                        "subject": subject,
+                        "sid": int(sid),
+                        "reply": reply
+                    }
+                    self.needed = int(needed_bytes)
+                except ValueError:
+                    raise ErrProtocol("nats: malformed MSG")
+                return MSG_OP, None, end + CRLF_SIZE
+        elif c == _P_:
+            op = bytes(buf[pos:end]).rstrip()
+            if op == PING_OP:
+                return PING_OP, None, end + CRLF_SIZE
+            if op == PONG_OP:
+                return PONG_OP, None, end + CRLF_SIZE
+        elif c == _PLUS_:
+            if bytes(buf[pos:end]).rstrip() == OK_OP:
+                return OK_OP, None, end + CRLF_SIZE
+        elif c == _MINUS_:
+            if buf.startswith(ERR_OP_PREFIXES, pos):
+                err_msg = bytes(buf[pos + ERR_OP_SIZE:end]).strip()
+                return ERR_OP, err_msg if err_msg else None, end + CRLF_SIZE
+        elif c == _I_:
+            if buf.startswith(INFO_OP_PREFIXES, pos):
+                info_line = bytes(buf[pos + INFO_OP_SIZE:end]).strip()
+                if info_line:
+                    return INFO_OP, info_line, end + CRLF_SIZE
+        raise ErrProtocol("nats: unknown protocol")
+
+    def _match_control_line(self):
+        """
+        Reference implementation of the control line parsing,
+        trying each one of the protocol regular expressions
+        against the buffer in turn from the read position.
+        """
+        msg = MSG_RE.match(self.buf, self.pos)
+        if msg:
+            try:
+                subject, sid, _, reply, needed_bytes = msg.groups()
+                self.msg_arg["subject"] = subject
+                self.msg_arg["sid"] = int(sid)
+                if reply:
+                    self.msg_arg["reply"] = reply
+                else:
+                    self.msg_arg["reply"] = b''
+                self.needed = int(needed_bytes)
+                return MSG_OP, None, msg.end()
+            except:
+                raise ErrProtocol("nats: malformed MSG")
+
+        ok = OK_RE.match(self.buf, self.pos)
+        if ok:
+            # Do nothing and just skip.
+            return OK_OP, None, ok.end()
+
+        err = ERR_RE.match(self.buf, self.pos)
+        if err:
+            return ERR_OP, err.group(1), err.end()
+
+        ping = PING_RE.match(self.buf, self.pos)
+        if ping:
+            return PING_OP, None, ping.end()
+
+        pong = PONG_RE.match(self.buf, self.pos)
+        if pong:
+            return PONG_OP, None, pong.end()
+
+        info = INFO_RE.match(self.buf, self.pos)
+        if info:
+            return INFO_OP, info.group(1), info.end()
+
+        # If nothing matched at this point, then probably
+        # a split buffer and need to gather more bytes,
+        # otherwise it would mean that there is an issue
+        # and we're getting malformed control lines.
+        if len(self.buf) - self.pos < MAX_CONTROL_LINE_SIZE and self.buf.find(
+                _CRLF_, self.pos) < 0:
+            return None
+        raise ErrProtocol("nats: unknown protocol")
+
+
+def _is_pending(result):
+    return result is not None and is_future(result) and not result.done()
+
+
+class ChunkPool(object):
+    """
+    Pool of reusable buffers for holding message payloads,
+    bucketed into power of two size classes.
+    """
+
+    def __init__(self, max_free=DEFAULT_POOL_MAX_FREE_CHUNKS):
+        self.max_free = max_free
+        self._free = {}
+
+    def acquire(self, size):
+        """
+        Takes a chunk of at least size bytes from the pool,
+        allocating a new one if none is free.
+        """
+        cap = max(MIN_CHUNK_SIZE, 1 << (size - 1).bit_length())
+        free = self._free.get(cap)
+        if free:
+            return free.pop()
+        return bytearray(cap)
+
+    def release(self, chunk):
+        """
+        Returns a chunk to the pool so that it can be reused,
+        dropping it instead if there are enough free ones already.
+        """
+        free = self._free.setdefault(len(chunk), [])
+        if len(free) < self.max_free:
+            free.append(chunk)
 
 
 class ErrProtocol(Exception):
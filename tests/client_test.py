@@ -8,6 +8,7 @@ import tornado.gen
 import tornado.ioloop
 import tornado.iostream
 import tornado.tcpserver
+import tornado.queues
 import subprocess
 import threading
 import tempfile
@@ -18,14 +19,30 @@ import ssl
 import os
 
 from datetime import timedelta
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
 from collections import defaultdict as Hash
-from nats.io import Client
+from nats.io.client import Client, Subscription
+from nats.io.client import MIN_READ_CHUNK_SIZE, MAX_READ_CHUNK_SIZE, READ_CHUNK_SHRINK_READS
+from nats.io.client import MAX_PREPARED_HEADERS, LARGE_PAYLOAD_SIZE
+from nats.io.client import RECONNECT_BUF_DROP_OLDEST, RECONNECT_BUF_DROP_SUBJECT_OLDEST
+from nats.io.client import SpillFile
+from nats.io.codec import ZlibCodec
+from nats.io.workers import ProcessPool
 from nats.io.errors import *
 from nats.io.utils import new_inbox, INBOX_PREFIX
 from nats.protocol.parser import *
 from nats import __lang__, __version__
 
 
+def process_pool_handler(msg):
+    if msg.data.startswith(b'fail'):
+        raise ValueError(msg.data[:8])
+    return (os.getpid(), msg.subject, msg.data[:8], len(msg.data))
+
+
 class Gnatsd(object):
     def __init__(
             self,
@@ -489,6 +506,155 @@ class ClientTest(tornado.testing.AsyncTestCase):
         self.assertEqual("tests.3", msgs[3].subject)
         yield nc.close()
 
+    @tornado.testing.gen_test
+    def test_subscribe_zero_copy(self):
+        nc = Client()
+        msgs = []
+
+        def subscription_handler(msg):
+            msgs.append((type(msg.data), msg.data.readonly, msg.data.tobytes()))
+
+        yield nc.connect(io_loop=self.io_loop, zero_copy=True)
+        yield nc.subscribe("tests.>", cb=subscription_handler)
+
+        payload = b'A' * (256 * 1024)
+        for i in range(0, 5):
+            yield nc.publish("tests.{0}".format(i), payload)
+        yield nc.flush()
+        yield tornado.gen.sleep(0.5)
+
+        self.assertEqual(5, len(msgs))
+        for msg in msgs:
+            self.assertEqual((memoryview, True, payload), msg)
+
+        # Buffers were given back to the pool after each callback.
+        free = nc._ps.pool._free[256 * 1024]
+        self.assertTrue(0 < len(free) <= 5)
+        yield nc.close()
+
+    @tornado.testing.gen_test
+    def test_forward_zero_copy_payloads(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop, zero_copy=True)
+
+        def forward(msg):
+            nc.publish_nowait("out", msg.data)
+
+        received = []
+
+        def persist(msg):
+            received.append(msg.data.tobytes())
+
+        yield nc.subscribe("in", cb=forward)
+        yield nc.subscribe("out", cb=persist)
+
+        # Large payloads are queued by reference and small ones joined.
+        payloads = []
+        for i in range(0, 50):
+            size = 64 * 1024 if i % 2 == 0 else 1024
+            payloads.append(chr(ord('a') + i % 26) * size)
+            nc.publish_nowait("in", payloads[-1])
+        yield nc.flush()
+        yield tornado.gen.sleep(0.5)
+        yield nc.flush()
+
+        self.assertEqual(payloads, received)
+        yield nc.close()
+
+    @tornado.testing.gen_test
+    def test_subscribe_adaptive_read_chunk_size(self):
+        nc = Client()
+        msgs = []
+
+        def subscription_handler(msg):
+            msgs.append(msg)
+
+        yield nc.connect(
+            io_loop=self.io_loop,
+            read_chunk_size=4096,
+            adaptive_read_chunk_size=True)
+        self.assertEqual(4096, nc.io.read_chunk_size)
+        yield nc.subscribe("tests.>", cb=subscription_handler)
+
+        payload = b'A' * (64 * 1024)
+        for i in range(0, 20):
+            yield nc.publish("tests.{0}".format(i), payload)
+        yield nc.flush()
+        yield tornado.gen.sleep(0.5)
+
+        self.assertEqual(20, len(msgs))
+        for msg in msgs:
+            self.assertEqual(payload, msg.data)
+
+        # Reads were filling up the chunk so it got bigger.
+        self.assertTrue(nc.io.read_chunk_size > 4096)
+        yield nc.close()
+
+    def test_next_read_chunk_size(self):
+        nc = Client()
+        nc.io = tornado.iostream.IOStream(socket.socket())
+        self.assertEqual(8192, nc._next_read_chunk_size(4096, 4096))
+        self.assertEqual(8192, nc.io.read_chunk_size)
+        self.assertEqual(
+            MAX_READ_CHUNK_SIZE,
+            nc._next_read_chunk_size(MAX_READ_CHUNK_SIZE, MAX_READ_CHUNK_SIZE))
+
+        # Only shrinks after several reads in a row which were mostly empty.
+        size = 65536
+        for i in range(0, READ_CHUNK_SHRINK_READS - 1):
+            self.assertEqual(size, nc._next_read_chunk_size(size, 10))
+        self.assertEqual(size, nc._next_read_chunk_size(size, size // 2))
+        for i in range(0, READ_CHUNK_SHRINK_READS):
+            size = nc._next_read_chunk_size(size, 10)
+        self.assertEqual(32768, size)
+        self.assertEqual(
+            MIN_READ_CHUNK_SIZE,
+            nc._next_read_chunk_size(MIN_READ_CHUNK_SIZE, 10))
+        nc.io.close()
+
+    @tornado.testing.gen_test
+    def test_subscribe_stream(self):
+        nc = Client()
+        streams = []
+
+        def start_cb(msg, size):
+            streams.append([msg.subject, size, []])
+
+        @tornado.gen.coroutine
+        def data_cb(msg, chunk):
+            streams[-1][2].append(chunk)
+            yield tornado.gen.moment
+
+        def end_cb(msg):
+            streams[-1][2] = b''.join(streams[-1][2])
+
+        yield nc.connect(io_loop=self.io_loop)
+        sid = yield nc.subscribe_stream(
+            "tests.>",
+            start_cb=start_cb,
+            data_cb=data_cb,
+            end_cb=end_cb,
+            max_msgs=2)
+        self.assertTrue(sid in nc._ps.streams)
+
+        payload = b'A' * (512 * 1024)
+        for i in range(0, 3):
+            yield nc.publish("tests.{0}".format(i), payload)
+        yield nc.flush()
+        yield tornado.gen.sleep(0.5)
+
+        self.assertEqual([
+            [u"tests.0", len(payload), payload],
+            [u"tests.1", len(payload), payload],
+        ], streams)
+        self.assertFalse(sid in nc._subs)
+        self.assertFalse(sid in nc._ps.streams)
+
+        # Last message was still received but not streamed.
+        self.assertEqual(3, nc.stats['in_msgs'])
+        self.assertEqual(3 * len(payload), nc.stats['in_bytes'])
+        yield nc.close()
+
     @tornado.testing.gen_test
     def test_subscribe_async(self):
         nc = Client()
@@ -517,6 +683,29 @@ class ClientTest(tornado.testing.AsyncTestCase):
         self.assertEqual("tests.3", msgs[3].subject)
         yield nc.close()
 
+    @tornado.testing.gen_test
+    def test_subscribe_max_msgs(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop)
+
+        msgs = []
+
+        @tornado.gen.coroutine
+        def subscription_handler(msg):
+            msgs.append(msg.data)
+            yield tornado.gen.moment
+
+        sid = yield nc.subscribe("foo", cb=subscription_handler, max_msgs=3)
+        for i in range(0, 5):
+            nc.publish_nowait("foo", str(i))
+        yield nc.flush()
+        yield tornado.gen.sleep(0.2)
+
+        # All received in the same read, delivered up to the limit.
+        self.assertEqual(['0', '1', '2'], msgs)
+        self.assertNotIn(sid, nc._subs)
+        yield nc.close()
+
     @tornado.testing.gen_test
     def test_subscribe_async_non_coro(self):
         nc = Client()
@@ -569,6 +758,167 @@ class ClientTest(tornado.testing.AsyncTestCase):
         self.assertEqual(2, nc.stats['in_msgs'])
         self.assertEqual(2, nc.stats['out_msgs'])
 
+    @tornado.testing.gen_test
+    def test_publish_many(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop)
+
+        log = Log()
+        yield nc.subscribe(">", "", log.persist)
+        yield nc.publish_many([
+            ("one", "hello"),
+            ("two", "world", "reply.two"),
+            ("one", "again"),
+        ])
+        yield nc.publish_many([])
+        yield nc.flush()
+        yield tornado.gen.sleep(0.5)
+
+        self.assertEqual(2, len(log.records.keys()))
+        self.assertEqual(["hello", "again"],
+                         [msg.data for msg in log.records['one']])
+        self.assertEqual("world", log.records['two'][0].data)
+        self.assertEqual("reply.two", log.records['two'][0].reply)
+        self.assertEqual(15, nc.stats['out_bytes'])
+        self.assertEqual(3, nc.stats['out_msgs'])
+        self.assertEqual(3, nc.stats['in_msgs'])
+
+        # Nothing is sent when one of the payloads is too large.
+        with self.assertRaises(ErrMaxPayload):
+            yield nc.publish_many([
+                ("one", "hello"),
+                ("large-message", "A" * (nc._max_payload_size + 1)),
+            ])
+        self.assertEqual(3, nc.stats['out_msgs'])
+        self.assertEqual(0, nc._pending_size)
+        yield nc.close()
+
+    @tornado.testing.gen_test
+    def test_publish_nowait(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop)
+
+        log = Log()
+        yield nc.subscribe(">", "", log.persist)
+        pending = len(nc._pending)
+        for i in range(0, 100):
+            nc.publish_nowait("one", "hello")
+        nc.publish_nowait("two", "world", "reply.two")
+
+        # Commands are pending with a single flush scheduled for them.
+        self.assertEqual(pending + 101, len(nc._pending))
+        self.assertTrue(nc._flush_scheduled)
+        self.assertEqual(101, nc.stats['out_msgs'])
+        self.assertEqual(505, nc.stats['out_bytes'])
+
+        yield nc.flush()
+        yield tornado.gen.sleep(0.5)
+        self.assertFalse(nc._flush_scheduled)
+        self.assertEqual(100, len(log.records['one']))
+        self.assertEqual("reply.two", log.records['two'][0].reply)
+
+        with self.assertRaises(ErrMaxPayload):
+            nc.publish_nowait("large-message",
+                              "A" * (nc._max_payload_size + 1))
+        yield nc.close()
+        with self.assertRaises(ErrConnectionClosed):
+            nc.publish_nowait("one", "hello")
+
+    @tornado.testing.gen_test
+    def test_publish_with_codec(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop)
+
+        codec = ZlibCodec(threshold=64)
+        log = Log()
+        raw = Log()
+        yield nc.subscribe("events.>", "", log.persist, codec=codec)
+        yield nc.subscribe("events.>", "", raw.persist)
+        payload = json.dumps([{"id": i, "event": "created"} for i in range(100)])
+        yield nc.publish("events.large", payload, codec=codec)
+        yield nc.publish("events.small", "hello", codec=codec)
+        nc.publish_nowait("events.large", payload, codec=codec)
+        yield nc.publish_many([("events.large", payload)], codec=codec)
+        yield nc.flush()
+        yield tornado.gen.sleep(0.5)
+
+        self.assertEqual([payload] * 3,
+                         [msg.data for msg in log.records['events.large']])
+        self.assertEqual("hello", log.records['events.small'][0].data)
+        self.assertTrue(len(raw.records['events.large'][0].data) < len(payload))
+        self.assertEqual("hello", raw.records['events.small'][0].data)
+
+        self.assertEqual(3 * len(payload) + 5, nc.stats['codec_raw_bytes'])
+        self.assertEqual(nc.stats['out_bytes'], nc.stats['codec_encoded_bytes'])
+        self.assertTrue(nc.stats['compression_ratio'] > 1)
+        self.assertTrue(nc.stats['codec_encode_time'] > 0)
+        self.assertTrue(nc.stats['codec_decode_time'] > 0)
+        yield nc.close()
+
+    @tornado.testing.gen_test
+    def test_publish_prepared_subject(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop)
+
+        log = Log()
+        yield nc.subscribe(">", "", log.persist)
+        one = nc.prepare(u"one")
+        two = nc.prepare("two", "reply.two")
+        self.assertEqual(b'one', one.subject)
+        yield nc.publish(one, "hello")
+        nc.publish_nowait(one, "world")
+        nc.publish_nowait(two, "hi")
+        yield nc.publish_many([(one, "again"), (two, "hey", "reply.other")])
+        yield nc.flush()
+        yield tornado.gen.sleep(0.5)
+
+        self.assertEqual(["hello", "world", "again"],
+                         [msg.data for msg in log.records['one']])
+        self.assertEqual([("hi", "reply.two"), ("hey", "reply.other")],
+                         [(msg.data, msg.reply)
+                          for msg in log.records['two']])
+
+        # Headers are cached per payload size.
+        self.assertEqual(b'PUB one  5\r\n', one._headers[5])
+        self.assertEqual([5], one._headers.keys())
+        self.assertTrue(one.header(5) is one.header(5))
+        self.assertEqual(b'PUB two reply.two 2\r\n', two._headers[2])
+        for i in range(0, MAX_PREPARED_HEADERS * 2):
+            one.header(i)
+        self.assertEqual(MAX_PREPARED_HEADERS, len(one._headers))
+        self.assertEqual(b'PUB one  1000\r\n', one.header(1000))
+        yield nc.close()
+
+    @tornado.testing.gen_test
+    def test_publish_large_payload_by_reference(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop)
+
+        log = Log()
+        yield nc.subscribe(">", "", log.persist)
+        yield nc.flush()
+
+        small = b'A' * 10
+        large = b'B' * LARGE_PAYLOAD_SIZE
+        nc.publish_nowait("small", small)
+        nc.publish_nowait("large", large)
+        nc.publish_nowait("small", small)
+        self.assertEqual(5, len(nc._pending))
+        self.assertTrue(nc._pending[2] is large)
+        self.assertEqual(b'PUB large  %d\r\n' % len(large), nc._pending[1])
+        yield nc.publish_many([("small", small), ("large", large),
+                               ("small", small)])
+        self.assertEqual(8, len(nc._pending))
+        self.assertTrue(nc._pending[6] is large)
+
+        yield nc.flush()
+        yield tornado.gen.sleep(0.5)
+        self.assertEqual([large, large],
+                         [msg.data for msg in log.records['large']])
+        self.assertEqual(4, len(log.records['small']))
+        self.assertEqual(0, nc._pending_size)
+        yield nc.close()
+
     @tornado.testing.gen_test(timeout=15)
     def test_publish_race_condition(self):
         # This tests a race condition fixed in #23 where a series of
@@ -1023,6 +1373,691 @@ class ClientTest(tornado.testing.AsyncTestCase):
             self.assertEqual(expected_outstanding, len(nc._pongs))
             self.assertEqual(i + 1, nc._pongs_received)
 
+    @tornado.testing.gen_test
+    def test_read_loop_protocol_error(self):
+        class Parser():
+            def parse(self, data=''):
+                raise ErrProtocol("nats: unknown protocol")
+
+        errors = []
+        nc = Client()
+        nc._ps = Parser()
+        yield nc.connect(
+            io_loop=self.io_loop,
+            allow_reconnect=False,
+            error_cb=errors.append)
+
+        # Get the server to send something to the parser.
+        yield nc._send_ping()
+        yield tornado.gen.sleep(0.2)
+        self.assertTrue(type(errors[0]) is ErrProtocol)
+        self.assertTrue(nc.io.closed())
+        self.assertTrue(nc.is_closed)
+
+    @tornado.testing.gen_test(timeout=10)
+    def test_read_loop_error_cb_raises(self):
+        errors = []
+
+        def error_cb(e):
+            errors.append(e)
+            if isinstance(e, ErrSlowConsumer):
+                raise Exception("error_cb failed")
+
+        nc = Client()
+        yield nc.connect(
+            io_loop=self.io_loop, error_cb=error_cb, reconnect_time_wait=0.1)
+
+        @tornado.gen.coroutine
+        def slow_handler(msg):
+            yield tornado.gen.sleep(0.5)
+
+        log = Log()
+        yield nc.subscribe("slow", cb=slow_handler, pending_msgs_limit=1)
+        yield nc.subscribe("bar", "", log.persist)
+        for i in range(0, 3):
+            nc.publish_nowait("slow", "hello")
+        yield nc.flush()
+
+        # Reported and then reconnected with the parser reset.
+        yield tornado.gen.sleep(0.5)
+        self.assertTrue(isinstance(errors[0], ErrSlowConsumer))
+        self.assertEqual("error_cb failed", str(errors[1]))
+        self.assertEqual(1, nc.stats['reconnects'])
+        self.assertTrue(nc.is_connected)
+
+        for i in range(0, 5):
+            yield nc.publish("bar", str(i))
+        yield nc.flush()
+        yield tornado.gen.sleep(0.2)
+        self.assertEqual(5, len(log.records['bar']))
+        yield nc.close()
+
+    @tornado.testing.gen_test(timeout=10)
+    def test_flusher_control_write_buffer_full(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop, max_write_buffer_size=1024)
+
+        log = Log()
+        yield nc.subscribe("foo", "", log.persist)
+        yield nc.flush()
+
+        # Larger than the stream takes at once, so that writing the
+        # control lane fails without any pending data, first in a new
+        # flusher and then after data has been written.
+        for i in range(0, 2):
+            if i > 0:
+                for j in range(0, 10):
+                    yield nc.publish("foo", "hello")
+                yield nc.flush()
+            nc.io.max_write_buffer_size = 1024
+            yield nc.subscribe("b" * 2048, cb=log.persist)
+            yield tornado.gen.sleep(0.1)
+            self.assertEqual(1, len(nc._control))
+            self.assertEqual(0, nc._pending_size)
+
+            nc.io.max_write_buffer_size = None
+            yield nc.publish("foo", "world")
+            yield nc.flush(timeout=1)
+            self.assertEqual([], nc._control)
+            self.assertEqual(0, nc._pending_size)
+
+        self.assertEqual(12, len(log.records['foo']))
+        yield nc.close()
+
+    @tornado.testing.gen_test
+    def test_flusher_linger_and_max_batch_bytes(self):
+        nc = Client()
+        yield nc.connect(
+            io_loop=self.io_loop,
+            flush_linger=0.2,
+            flush_max_batch_bytes=1024,
+            max_inflight_bytes=1024)
+
+        log = Log()
+        yield nc.subscribe(">", "", log.persist)
+        yield nc.flush()
+
+        writes = []
+        write = nc.io.write
+
+        def record_write(data):
+            writes.append(len(data))
+            return write(data)
+
+        nc.io.write = record_write
+
+        # Small batches wait for the linger before being written.
+        for i in range(0, 10):
+            nc.publish_nowait("one", "hello")
+        yield tornado.gen.sleep(0.1)
+        self.assertEqual([], writes)
+        yield tornado.gen.sleep(0.2)
+        self.assertEqual([190], writes)
+
+        # Large ones are written right away in batches of max bytes.
+        for i in range(0, 100):
+            nc.publish_nowait("one", "hello")
+        yield tornado.gen.sleep(0.1)
+        self.assertEqual([190, 1026, 874], writes)
+        self.assertEqual(0, nc._inflight_size)
+
+        yield nc.flush()
+        self.assertEqual(110, len(log.records['one']))
+        yield nc.close()
+
+    @tornado.testing.gen_test
+    def test_flusher_stream_closed_after_batches_written(self):
+        nc = Client()
+        yield nc.connect(
+            io_loop=self.io_loop,
+            reconnect_time_wait=0.1,
+            flush_max_batch_bytes=1024)
+
+        sub = Client()
+        yield sub.connect(io_loop=self.io_loop)
+        log = Log()
+        yield sub.subscribe("one", "", log.persist)
+        yield sub.flush()
+
+        writes = []
+        write = nc.io.write
+
+        def close_on_second_write(data):
+            writes.append(len(data))
+            if len(writes) == 2:
+                raise tornado.iostream.StreamClosedError()
+            return write(data)
+
+        nc.io.write = close_on_second_write
+
+        # The connection is lost after the first batch was written,
+        # so only the rest is written again once reconnected.
+        for i in range(0, 100):
+            nc.publish_nowait("one", "hello")
+        while nc.stats['reconnects'] == 0:
+            yield tornado.gen.sleep(0.05)
+        self.assertEqual([1026, 874], writes)
+
+        yield nc.flush()
+        yield tornado.gen.sleep(0.2)
+        self.assertEqual(100, len(log.records['one']))
+        yield nc.close()
+        yield sub.close()
+
+    @tornado.testing.gen_test
+    def test_publish_backpressure(self):
+        nc = Client()
+        events = []
+        yield nc.connect(
+            io_loop=self.io_loop,
+            pending_high_watermark=1024,
+            backpressure_cb=events.append)
+        self.assertEqual(512, nc._pending_low_watermark)
+
+        log = Log()
+        yield nc.subscribe(">", "", log.persist)
+        yield nc.flush()
+
+        # Each command is 19 bytes so the 54th reaches the high watermark.
+        published = 0
+        with self.assertRaises(ErrBackpressure):
+            while True:
+                nc.publish_nowait("one", "hello")
+                published += 1
+        self.assertEqual(54, published)
+        self.assertEqual([True], events)
+
+        # Waits until the flusher has written the pending commands.
+        yield nc.publish("one", "hello")
+        self.assertEqual([True, False], events)
+        yield nc.flush()
+        yield tornado.gen.sleep(0.2)
+        self.assertEqual(55, len(log.records['one']))
+
+        # Publishers still waiting are released on close.
+        for i in range(0, 54):
+            nc.publish_nowait("one", "hello")
+        future = nc.publish("one", "hello")
+        yield nc.close()
+        with self.assertRaises(ErrConnectionClosed):
+            yield future
+        self.assertEqual([True, False, True, False], events)
+
+    @tornado.testing.gen_test
+    def test_publish_reconnect_buffer(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop, reconnect_buf_size=100)
+
+        log = Log()
+        yield nc.subscribe(">", "", log.persist)
+        yield nc.flush()
+
+        # Simulate an outage, each of the commands is 19 bytes.
+        nc._status = Client.RECONNECTING
+        for i in range(1, 6):
+            nc.publish_nowait("one", "msg-%d" % i)
+        with self.assertRaises(ErrReconnectBufExceeded):
+            nc.publish_nowait("one", "msg-6")
+        with self.assertRaises(ErrReconnectBufExceeded):
+            yield nc.publish_many([("two", "msg-6"), ("two", "msg-7")])
+        self.assertEqual(95, nc._reconnect_buffered)
+        self.assertEqual(3, nc.stats['reconnect_dropped_msgs'])
+
+        nc._reconnect_buf_policy = RECONNECT_BUF_DROP_OLDEST
+        nc.publish_nowait("two", "msg-6")
+        nc._reconnect_buf_policy = RECONNECT_BUF_DROP_SUBJECT_OLDEST
+        nc.publish_nowait("two", "msg-7")
+        nc.publish_nowait("six", "msg-8")
+        self.assertEqual(95, nc._reconnect_buffered)
+        self.assertEqual(152, nc.stats['reconnect_buffered_bytes'])
+        self.assertEqual(6, nc.stats['reconnect_dropped_msgs'])
+        self.assertEqual(114, nc.stats['reconnect_dropped_bytes'])
+
+        with self.assertRaises(ErrReconnectBufExceeded):
+            nc.publish_nowait("six", "A" * 100)
+
+        # Sent in order once reconnected.
+        nc._status = Client.CONNECTED
+        nc._flush_reconnect_buf()
+        yield nc.flush()
+        yield tornado.gen.sleep(0.2)
+        self.assertEqual(["msg-3", "msg-4", "msg-5"],
+                         [msg.data for msg in log.records['one']])
+        self.assertEqual(["msg-7"], [msg.data for msg in log.records['two']])
+        self.assertEqual(["msg-8"], [msg.data for msg in log.records['six']])
+        self.assertEqual(0, nc._reconnect_buffered)
+        yield nc.close()
+
+    @tornado.testing.gen_test
+    def test_publish_reconnect_spill(self):
+        spill_path = os.path.join(tempfile.mkdtemp(), 'reconnect.spill')
+        nc = Client()
+        yield nc.connect(
+            io_loop=self.io_loop,
+            reconnect_buf_size=None,
+            reconnect_spill_path=spill_path,
+            reconnect_spill_threshold=40)
+
+        log = Log()
+        yield nc.subscribe(">", "", log.persist)
+        yield nc.flush()
+
+        # Two of the commands fit in memory and the rest are spilled.
+        nc._status = Client.RECONNECTING
+        for i in range(1, 7):
+            nc.publish_nowait("one", "msg-%d" % i)
+        self.assertEqual(2, len(nc._reconnect_buf))
+        self.assertEqual(76, len(nc._spill))
+        self.assertEqual(114, nc._reconnect_buffered)
+        self.assertTrue(os.path.exists(spill_path))
+
+        # Oldest are dropped from memory first and then from the file.
+        nc._reconnect_buf_size = 114
+        nc._reconnect_buf_policy = RECONNECT_BUF_DROP_OLDEST
+        for i in range(7, 10):
+            nc.publish_nowait("two", "msg-%d" % i)
+        self.assertEqual(114, len(nc._spill))
+        self.assertEqual(3, nc.stats['reconnect_dropped_msgs'])
+
+        yield nc._replay_spill()
+        self.assertEqual(0, len(nc._spill))
+        nc._status = Client.CONNECTED
+        yield nc.flush()
+        yield tornado.gen.sleep(0.2)
+        self.assertEqual(["msg-4", "msg-5", "msg-6"],
+                         [msg.data for msg in log.records['one']])
+        self.assertEqual(["msg-7", "msg-8", "msg-9"],
+                         [msg.data for msg in log.records['two']])
+
+        yield nc.close()
+        self.assertFalse(os.path.exists(spill_path))
+
+    @tornado.testing.gen_test(timeout=30)
+    def test_publish_during_spill_replay(self):
+        spill_path = os.path.join(tempfile.mkdtemp(), 'reconnect.spill')
+        nc = Client()
+        errors = []
+
+        def error_cb(e):
+            errors.append(e)
+
+        yield nc.connect(
+            io_loop=self.io_loop,
+            error_cb=error_cb,
+            reconnect_time_wait=0.5,
+            reconnect_buf_size=None,
+            reconnect_spill_path=spill_path,
+            reconnect_spill_threshold=1024)
+
+        received = []
+
+        def handler(msg):
+            received.append(msg.data[:8])
+
+        yield nc.subscribe("one", cb=handler, pending_msgs_limit=100000)
+        yield nc.flush()
+
+        self.server_pool[0].finish()
+        self.threads[0].join()
+        while not nc.is_reconnecting:
+            yield tornado.gen.sleep(0.05)
+        padding = "x" * 1024
+        for i in range(0, 30000):
+            nc.publish_nowait("one", "{0:08d}".format(i) + padding)
+        self.assertTrue(len(nc._spill) > 0)
+
+        server = Gnatsd(port=4222)
+        t = threading.Thread(target=server.start)
+        self.threads[0] = t
+        self.server_pool[0] = server
+        t.start()
+
+        # Publish while the spilled messages are being replayed.
+        while not nc.is_connected:
+            yield tornado.gen.sleep(0.001)
+        for i in range(30000, 32000):
+            nc.publish_nowait("one", "{0:08d}".format(i) + padding)
+            if i % 10 == 0:
+                yield tornado.gen.moment
+        yield nc.flush(timeout=10)
+        deadline = time.time() + 10
+        while len(received) < 32000 and time.time() < deadline:
+            yield tornado.gen.sleep(0.1)
+
+        self.assertEqual(["{0:08d}".format(i) for i in range(0, 32000)],
+                         received)
+        disconnected = (socket.error, tornado.iostream.StreamClosedError)
+        self.assertEqual(
+            [], [e for e in errors if not isinstance(e, disconnected)])
+        yield nc.close()
+
+    @tornado.testing.gen_test(timeout=30)
+    def test_spill_replay_small_write_buffer(self):
+        spill_path = os.path.join(tempfile.mkdtemp(), 'reconnect.spill')
+        nc = Client()
+        yield nc.connect(
+            io_loop=self.io_loop,
+            reconnect_time_wait=0.5,
+            reconnect_buf_size=None,
+            reconnect_spill_path=spill_path,
+            reconnect_spill_threshold=1024,
+            max_write_buffer_size=64 * 1024)
+
+        received = []
+
+        def handler(msg):
+            received.append(int(msg.data[:8]))
+
+        yield nc.subscribe("one", cb=handler, pending_msgs_limit=100000)
+        yield nc.flush()
+
+        self.server_pool[0].finish()
+        self.threads[0].join()
+        while not nc.is_reconnecting:
+            yield tornado.gen.sleep(0.05)
+        padding = "x" * 1024
+        for i in range(0, 2000):
+            nc.publish_nowait("one", "{0:08d}".format(i) + padding)
+        self.assertTrue(len(nc._spill) > 64 * 1024)
+
+        server = Gnatsd(port=4222)
+        t = threading.Thread(target=server.start)
+        self.threads[0] = t
+        self.server_pool[0] = server
+        t.start()
+
+        # Replayed in chunks which fit in the stream.
+        yield nc.flush(timeout=10)
+        deadline = time.time() + 5
+        while len(received) < 2000 and time.time() < deadline:
+            yield tornado.gen.sleep(0.1)
+        self.assertEqual(list(range(0, 2000)), received)
+        self.assertFalse(nc._replaying)
+        yield nc.close()
+
+    @tornado.testing.gen_test(timeout=30)
+    def test_spill_replay_stream_closed(self):
+        spill_path = os.path.join(tempfile.mkdtemp(), 'reconnect.spill')
+        nc = Client()
+        errors = []
+
+        def error_cb(e):
+            errors.append(e)
+
+        yield nc.connect(
+            io_loop=self.io_loop,
+            error_cb=error_cb,
+            reconnect_time_wait=0.5,
+            reconnect_buf_size=None,
+            reconnect_spill_path=spill_path,
+            reconnect_spill_threshold=1024)
+
+        received = []
+
+        def handler(msg):
+            received.append(int(msg.data[:8]))
+
+        yield nc.subscribe("one", cb=handler, pending_msgs_limit=100000)
+        yield nc.flush()
+
+        self.server_pool[0].finish()
+        self.threads[0].join()
+        while not nc.is_reconnecting:
+            yield tornado.gen.sleep(0.05)
+        padding = "x" * 1024
+        for i in range(0, 2000):
+            nc.publish_nowait("one", "{0:08d}".format(i) + padding)
+
+        # The connection is lost again while replaying the spill.
+        write = tornado.iostream.IOStream.write
+        chunks = []
+
+        def write_and_close(stream, data, *args, **kwargs):
+            if len(data) > 32 * 1024:
+                chunks.append(len(data))
+                if len(chunks) == 2:
+                    stream.close()
+            return write(stream, data, *args, **kwargs)
+
+        tornado.iostream.IOStream.write = write_and_close
+        try:
+            server = Gnatsd(port=4222)
+            t = threading.Thread(target=server.start)
+            self.threads[0] = t
+            self.server_pool[0] = server
+            t.start()
+
+            # What was not written is replayed once reconnected again.
+            deadline = time.time() + 10
+            while 1999 not in received and time.time() < deadline:
+                yield tornado.gen.sleep(0.1)
+        finally:
+            tornado.iostream.IOStream.write = write
+        self.assertTrue(len(chunks) > 2)
+        self.assertEqual(2, nc.stats['reconnects'])
+
+        # Only the messages of the chunk which was written before are
+        # missing, since they were delivered on the closed connection.
+        self.assertTrue(received[0] * (8 + 1024) <= chunks[0])
+        self.assertEqual(list(range(received[0], 2000)), received)
+        self.assertFalse(nc._replaying)
+        yield nc.flush()
+        yield nc.close()
+
+    @tornado.testing.gen_test
+    def test_publish_during_spill_replay_dropping_oldest(self):
+        spill_path = os.path.join(tempfile.mkdtemp(), 'reconnect.spill')
+        nc = Client()
+        yield nc.connect(
+            io_loop=self.io_loop,
+            reconnect_buf_size=None,
+            reconnect_spill_path=spill_path,
+            reconnect_spill_threshold=1024)
+
+        received = []
+
+        def handler(msg):
+            received.append(int(msg.data[:8]))
+
+        yield nc.subscribe("one", cb=handler, pending_msgs_limit=100000)
+        yield nc.flush()
+
+        # Spills more than is replayed at once, and is full.
+        nc._status = Client.RECONNECTING
+        padding = "x" * 100
+        for i in range(0, 4000):
+            nc.publish_nowait("one", "{0:08d}".format(i) + padding)
+        nc._reconnect_buf_size = nc._reconnect_buffered
+        nc._reconnect_buf_policy = RECONNECT_BUF_DROP_OLDEST
+
+        # Publishing while the first chunk of the spill is being written
+        # drops the oldest messages which are left in it.
+        write = nc.io.write
+
+        def slow_write(data):
+            write(data)
+            return tornado.gen.sleep(0.01)
+
+        nc.io.write = slow_write
+        nc._status = Client.CONNECTED
+        nc._replaying = True
+        replayed = nc._replay_spill()
+        while nc._spill._head == 0:
+            yield tornado.gen.moment
+        for i in range(4000, 6500):
+            nc.publish_nowait("one", "{0:08d}".format(i) + padding)
+        yield replayed
+        while len(nc._spill) > 0:
+            yield nc._replay_spill()
+        nc._flush_reconnect_buf()
+        nc._replaying = False
+        nc.io.write = write
+        yield nc.flush()
+
+        deadline = time.time() + 5
+        while (len(received) + nc.stats['reconnect_dropped_msgs'] < 6500
+               and time.time() < deadline):
+            yield tornado.gen.sleep(0.1)
+        self.assertTrue(nc.stats['reconnect_dropped_msgs'] > 0)
+        self.assertEqual(sorted(received), received)
+        self.assertEqual(len(set(received)), len(received))
+        self.assertEqual(6499, received[-1])
+        self.assertEqual(6500,
+                         len(received) + nc.stats['reconnect_dropped_msgs'])
+        self.assertTrue(nc.is_connected)
+        yield nc.close()
+
+    def test_spill_file(self):
+        spill_path = os.path.join(tempfile.mkdtemp(), 'reconnect.spill')
+        spill = SpillFile(spill_path, size=32)
+        spill.append(b'PUB a  1\r\n0\r\nPUB a  1\r\n1\r\n')
+        self.assertEqual(b'PUB a  1\r\n0\r\n', spill.read(20))
+
+        # Space which was read is reused before growing the file.
+        spill.append(bytearray(b'PUB b  1\r\n2\r\n'))
+        self.assertEqual(32, os.path.getsize(spill_path))
+        spill.append(memoryview(b'PUB c  1\r\n3\r\n'))
+        self.assertEqual(64, os.path.getsize(spill_path))
+        self.assertEqual(39, len(spill))
+        self.assertEqual(b'PUB a  1\r\n1\r\nPUB b  1\r\n2\r\n',
+                         spill.read(30))
+
+        # Commands are read whole even when larger than asked for.
+        self.assertEqual(b'PUB c  1\r\n3\r\n', spill.read(5))
+        self.assertEqual(0, len(spill))
+
+        spill.reset()
+        self.assertEqual(32, os.path.getsize(spill_path))
+        spill.append(b'PUB foo  5\r\nhello\r\nPUB foo  2\r\nhi\r\n')
+        self.assertEqual(19, spill.drop())
+        self.assertEqual(b'PUB foo  2\r\nhi\r\n', spill.read(100))
+
+        # Dropping after a read starts at the next command.
+        spill.append(b'PUB a  3\r\nabc\r\nPUB b  2\r\nde\r\n')
+        spill.append(b'PUB c  1\r\nf\r\n')
+        self.assertEqual(b'PUB a  3\r\nabc\r\n', spill.read(16))
+        self.assertEqual(14, spill.drop())
+        self.assertEqual(b'PUB c  1\r\nf\r\n', spill.read(100))
+        spill.close()
+        self.assertFalse(os.path.exists(spill_path))
+
+    @tornado.testing.gen_test
+    def test_control_lane(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop)
+        yield nc.flush()
+
+        writes = []
+        write = nc._write
+
+        def record(data):
+            writes.append(data)
+            return write(data)
+
+        nc._write = record
+        for i in range(0, 10):
+            nc.publish_nowait("foo", "bar")
+        pending_size = nc._pending_size
+
+        # Neither the reply to the server nor a heartbeat count as pending.
+        nc._process_ping()
+        yield nc._send_ping()
+        self.assertEqual(pending_size, nc._pending_size)
+        self.assertEqual([b'PONG\r\n', b'PING\r\n'], nc._control)
+
+        # Flushing PINGs stay behind the data they are flushing.
+        future = nc.flush()
+        self.assertEqual([b'PONG\r\n', b'PING\r\n'], nc._control)
+        yield future
+        self.assertEqual(b'PONG\r\nPING\r\n', writes[0])
+        self.assertTrue(writes[-1].endswith(b'bar\r\nPING\r\n'))
+        self.assertEqual(0, len(nc._pongs))
+        yield nc.close()
+
+    @tornado.testing.gen_test
+    def test_flush_coalesced(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop)
+        log = Log()
+        yield nc.subscribe("foo", "", log.persist)
+        yield nc.flush()
+        pongs_received = nc._pongs_received
+
+        # Flushes started before the flusher runs share a single PING.
+        flushes = []
+        for i in range(0, 100):
+            yield nc.publish("foo", "%d" % i)
+            flushes.append(nc.flush())
+        self.assertEqual(0, len(nc._pongs))
+        yield flushes
+        self.assertEqual(1, nc._pongs_received - pongs_received)
+        self.assertEqual(0, len(nc._pongs))
+        self.assertEqual(None, nc._next_flush_ping)
+
+        # The ones started meanwhile wait for the next one.
+        first = nc.flush()
+        yield tornado.gen.moment
+        self.assertEqual(1, len(nc._pongs))
+        second = nc.flush()
+        third = nc.flush()
+        yield [first, second, third]
+        self.assertEqual(3, nc._pongs_received - pongs_received)
+        yield tornado.gen.sleep(0.2)
+        self.assertEqual(100, len(log.records['foo']))
+        yield nc.close()
+
+    @tornado.testing.gen_test
+    def test_drain(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop)
+
+        received = []
+
+        @tornado.gen.coroutine
+        def handler(msg):
+            yield tornado.gen.sleep(0.01)
+            received.append(msg.data)
+
+        yield nc.subscribe("foo", cb=handler)
+        for i in range(0, 20):
+            yield nc.publish("foo", "%d" % i)
+        yield nc.flush()
+
+        # Messages which are already queued are still delivered.
+        future = nc.drain()
+        with self.assertRaises(ErrConnectionDraining):
+            yield nc.subscribe("bar", cb=handler)
+        with self.assertRaises(ErrConnectionDraining):
+            yield nc.subscribe_stream("bar", data_cb=handler)
+        with self.assertRaises(ErrConnectionDraining):
+            yield nc.drain()
+        drained, dropped = yield future
+        self.assertEqual(0, dropped)
+        self.assertTrue(drained > 0)
+        self.assertEqual(["%d" % i for i in range(0, 20)], received)
+        self.assertTrue(nc.is_closed)
+
+    @tornado.testing.gen_test
+    def test_drain_timeout(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop)
+
+        @tornado.gen.coroutine
+        def handler(msg):
+            yield tornado.gen.sleep(1)
+
+        yield nc.subscribe("foo", cb=handler)
+        for i in range(0, 5):
+            yield nc.publish("foo", "%d" % i)
+        yield nc.flush()
+        yield tornado.gen.sleep(0.1)
+
+        # The first message is being handled and the rest are dropped.
+        drained, dropped = yield nc.drain(timeout=0.2)
+        self.assertEqual(0, drained)
+        self.assertEqual(4, dropped)
+        self.assertTrue(nc.is_closed)
+
     @tornado.testing.gen_test
     def test_flush_timeout(self):
         class Parser():
@@ -1093,6 +2128,428 @@ class ClientTest(tornado.testing.AsyncTestCase):
         nc = Client()
         yield nc._process_msg(387, 'some-subject', 'some-reply', [0, 1, 2])
 
+    @tornado.testing.gen_test
+    def test_process_msgs_batch(self):
+        errors = []
+        nc = Client()
+        nc._error_cb = errors.append
+        sub = Subscription(subject='foo', cb=lambda msg: None, sid=1)
+        sub.pending_msgs_limit = 3
+        sub.pending_bytes_limit = 1024
+        sub.pending_queue = tornado.queues.Queue(maxsize=3)
+        nc._subs[1] = sub
+
+        batch = {
+            1: [('foo', '', 'hello', None) for i in range(0, 5)],
+            2: [('bar', '', 'world', None)],
+        }
+        yield nc._process_msgs(batch)
+        self.assertEqual(6, nc.stats['in_msgs'])
+        self.assertEqual(30, nc.stats['in_bytes'])
+        self.assertEqual(5, sub.received)
+        self.assertEqual(3, sub.pending_queue.qsize())
+        self.assertEqual(15, sub.pending_size)
+
+        # A single error for the messages dropped from the batch.
+        self.assertEqual(1, len(errors))
+        self.assertTrue(type(errors[0]) is ErrSlowConsumer)
+
+    @tornado.testing.gen_test
+    def test_process_msgs_lazy_subject_decoding(self):
+        nc = Client()
+        sub = Subscription(subject='foo', cb=lambda msg: None, sid=1)
+        sub.pending_bytes_limit = 1024
+        sub.pending_queue = tornado.queues.Queue()
+        nc._subs[1] = sub
+
+        yield nc._process_msgs({1: [('foo', 'bar', 'hello', None)]})
+        msg = sub.pending_queue.get_nowait()
+        self.assertEqual('foo', msg._raw_subject)
+        self.assertEqual('bar', msg._raw_reply)
+        self.assertEqual(u'foo', msg.subject)
+        self.assertTrue(type(msg.subject) is unicode)
+        self.assertEqual(u'bar', msg.reply)
+        self.assertTrue(msg._raw_subject is None)
+        self.assertTrue(msg._raw_reply is None)
+
+        msg.subject = 'quux'
+        self.assertEqual('quux', msg.subject)
+
+    @tornado.testing.gen_test
+    def test_process_msgs_interned_subjects(self):
+        msgs = []
+        nc = Client()
+        nc._max_interned_subjects = 2
+        nc._interned_subjects = {}
+        sub = Subscription(subject='>', cb=msgs.append, sid=1)
+        sub.pending_bytes_limit = 1024
+        sub.pending_queue = tornado.queues.Queue()
+        nc._subs[1] = sub
+
+        batch = {
+            1: [('foo', 'bar', 'a', None), ('foo', '', 'b', None),
+                ('bar', '', 'c', None), ('quux', '', 'd', None),
+                ('quux', '', 'e', None)],
+        }
+        yield nc._process_msgs(batch)
+        queued = list(sub.pending_queue._queue)
+        self.assertEqual(['foo', 'foo', 'bar', 'quux', 'quux'],
+                         [msg.subject for msg in queued])
+        self.assertEqual(['bar', '', '', '', ''],
+                         [msg.reply for msg in queued])
+        self.assertTrue(queued[0].subject is queued[1].subject)
+        self.assertTrue(queued[3].subject is queued[4].subject)
+
+        # Cache started over once it went past the limit.
+        self.assertEqual({'quux': u'quux'}, nc._interned_subjects)
+
+    @tornado.testing.gen_test
+    def test_subscribe_max_concurrency(self):
+        nc = Client()
+        errors = []
+
+        @tornado.gen.coroutine
+        def error_cb(e):
+            errors.append(e)
+
+        yield nc.connect(io_loop=self.io_loop, error_cb=error_cb)
+
+        msgs = []
+        running = []
+
+        @tornado.gen.coroutine
+        def subscription_handler(msg):
+            running.append(sub.in_flight)
+            yield tornado.gen.sleep(0.2)
+            msgs.append(msg.data)
+            if msg.data == b'5':
+                raise Exception("handler failed")
+
+        sid = yield nc.subscribe(
+            "tests.>", cb=subscription_handler, max_concurrency=3)
+        sub = nc._subs[sid]
+        for i in range(0, 9):
+            yield nc.publish("tests.{0}".format(i), str(i))
+        yield nc.flush()
+
+        # Three rounds of three messages each.
+        yield tornado.gen.sleep(0.1)
+        self.assertEqual(3, sub.in_flight)
+        self.assertEqual(6, sub.pending_queue.qsize())
+        yield tornado.gen.sleep(0.7)
+        self.assertEqual(9, len(msgs))
+        self.assertEqual(3, max(running))
+        self.assertEqual(0, sub.in_flight)
+        self.assertEqual(9, sub.delivered)
+        self.assertEqual(0, sub.pending_size)
+        self.assertTrue(sub.queue_wait_time > 1.5)
+        self.assertEqual(1, len(errors))
+
+        # All the messages up to the limit are handled.
+        del msgs[:]
+        sid = yield nc.subscribe(
+            "limited", cb=subscription_handler, max_concurrency=2, max_msgs=3)
+        sub = nc._subs[sid]
+        for i in range(0, 5):
+            nc.publish_nowait("limited", str(i))
+        yield nc.flush()
+        yield tornado.gen.sleep(0.6)
+        self.assertEqual(['0', '1', '2'], sorted(msgs))
+        yield nc.close()
+
+    @tornado.testing.gen_test
+    def test_subscribe_ordered_by_key(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop)
+
+        handled = Hash(list)
+        running = set()
+        concurrent = []
+
+        @tornado.gen.coroutine
+        def subscription_handler(msg):
+            entity = msg.subject.split('.')[1]
+            running.add(entity)
+            concurrent.append(len(running))
+            if msg.data == b'0':
+                yield tornado.gen.sleep(0.2)
+            else:
+                yield tornado.gen.moment
+            handled[entity].append(msg.data)
+            running.discard(entity)
+
+        sid = yield nc.subscribe(
+            "orders.>",
+            cb=subscription_handler,
+            key=lambda msg: msg.subject.split('.')[1],
+            lanes=4,
+            max_msgs=40)
+        for i in range(0, 10):
+            for entity in ("a", "b", "c", "d"):
+                yield nc.publish("orders.{0}".format(entity), str(i))
+        yield nc.flush()
+        yield tornado.gen.sleep(0.5)
+
+        # Each entity is handled in order while the lanes run concurrently.
+        self.assertEqual(4, len(handled))
+        for entity in ("a", "b", "c", "d"):
+            self.assertEqual([str(i) for i in range(0, 10)], handled[entity])
+        self.assertTrue(max(concurrent) > 1)
+        self.assertNotIn(sid, nc._subs)
+        yield nc.close()
+
+    @unittest.skipIf(ThreadPoolExecutor is None, "requires futures")
+    @tornado.testing.gen_test
+    def test_subscribe_executor(self):
+        nc = Client()
+        errors = []
+
+        def error_cb(e):
+            errors.append(e)
+
+        yield nc.connect(io_loop=self.io_loop, error_cb=error_cb)
+        executor = ThreadPoolExecutor(max_workers=4)
+
+        def subscription_handler(msg):
+            # Blocks the thread it runs in but not the loop.
+            time.sleep(0.4 - 0.1 * int(msg.data))
+            if msg.data == b'2':
+                raise Exception("handler failed")
+            return int(msg.data) * 10
+
+        results = []
+
+        def result_cb(msg, result):
+            results.append(result)
+
+        sid = yield nc.subscribe(
+            "tests.>",
+            cb=subscription_handler,
+            executor=executor,
+            result_cb=result_cb,
+            max_concurrency=4)
+        sub = nc._subs[sid]
+        for i in range(0, 4):
+            yield nc.publish("tests.{0}".format(i), str(i))
+        yield nc.flush()
+
+        start = time.time()
+        yield tornado.gen.sleep(0.05)
+        yield nc.flush()
+        self.assertTrue(time.time() - start < 0.2)
+        self.assertEqual(4, sub.in_flight)
+        self.assertEqual(4, sub.pending_size)
+
+        # Results are reported as the callbacks are done.
+        yield tornado.gen.sleep(0.5)
+        self.assertEqual([30, 10, 0], results)
+        self.assertEqual(1, len(errors))
+        self.assertEqual(0, sub.in_flight)
+        self.assertEqual(0, sub.pending_size)
+        yield nc.close()
+        executor.shutdown()
+
+    @unittest.skipIf(ThreadPoolExecutor is None, "requires futures")
+    @tornado.testing.gen_test
+    def test_subscribe_executor_ordered(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop)
+        executor = ThreadPoolExecutor(max_workers=4)
+
+        handled = []
+
+        def subscription_handler(msg):
+            # Later messages are quicker, so would be done first.
+            time.sleep(0.1 - 0.02 * int(msg.data))
+            handled.append((msg.subject, msg.data))
+            return msg.data
+
+        results = []
+
+        def result_cb(msg, result):
+            results.append((msg.subject, result))
+
+        yield nc.subscribe(
+            "tests.ordered.>",
+            cb=subscription_handler,
+            executor=executor,
+            result_cb=result_cb,
+            ordered=True)
+        yield nc.subscribe(
+            "tests.keyed.>",
+            cb=subscription_handler,
+            executor=executor,
+            result_cb=result_cb,
+            key=lambda msg: msg.subject)
+
+        sent = [("tests.ordered.{0}".format(i % 2), str(i))
+                for i in range(0, 4)]
+        for subject, data in sent:
+            yield nc.publish(subject, data)
+        yield nc.flush()
+
+        # One message at a time in the order they were received.
+        yield tornado.gen.sleep(0.4)
+        self.assertEqual(sent, handled)
+        self.assertEqual(sent, results)
+
+        del handled[:]
+        del results[:]
+        start = time.time()
+        for i in range(0, 4):
+            for key in ("a", "b"):
+                yield nc.publish("tests.keyed.{0}".format(key), str(i))
+        yield nc.flush()
+
+        # Messages with different keys are handled at the same time.
+        while len(results) < 8 and time.time() - start < 1:
+            yield tornado.gen.sleep(0.01)
+        self.assertTrue(time.time() - start < 0.4)
+        for key in ("a", "b"):
+            subject = "tests.keyed.{0}".format(key)
+            expected = [(subject, str(i)) for i in range(0, 4)]
+            self.assertEqual(expected, [h for h in handled if h[0] == subject])
+            self.assertEqual(expected, [r for r in results if r[0] == subject])
+        yield nc.close()
+        executor.shutdown()
+
+    @tornado.testing.gen_test
+    def test_subscribe_process_pool(self):
+        nc = Client()
+        errors = []
+
+        def error_cb(e):
+            errors.append(e)
+
+        yield nc.connect(io_loop=self.io_loop, error_cb=error_cb)
+
+        results = Hash(list)
+
+        def result_cb(msg, result):
+            self.assertEqual(msg.subject, result[1])
+            results[result[1]].append(result)
+
+        # Rings fit only a few of the messages at a time.
+        pool = ProcessPool(workers=2, ring_size=64 * 1024, max_in_flight=4)
+        sid = yield nc.subscribe(
+            "work.>",
+            cb=process_pool_handler,
+            result_cb=result_cb,
+            process_pool=pool,
+            key=lambda msg: msg.subject)
+        sub = nc._subs[sid]
+        for i in range(0, 20):
+            for entity in ("a", "b", "c"):
+                payload = "{0:08d}".format(i) + "x" * 20000
+                nc.publish_nowait("work.{0}".format(entity), payload)
+        nc.publish_nowait("work.a", "fail-now")
+        yield nc.flush()
+        yield tornado.gen.sleep(1.0)
+
+        self.assertEqual(3, len(results))
+        pids = set()
+        for entity in ("a", "b", "c"):
+            handled = results["work.{0}".format(entity)]
+            self.assertEqual(["{0:08d}".format(i) for i in range(0, 20)],
+                             [r[2] for r in handled])
+            self.assertEqual([20008] * 20, [r[3] for r in handled])
+            pids.update(r[0] for r in handled)
+        self.assertEqual(2, len(pids))
+        self.assertNotIn(os.getpid(), pids)
+        self.assertEqual(1, len(errors))
+        self.assertEqual("fail-now", errors[0].args[0])
+        self.assertEqual(0, sub.in_flight)
+        self.assertEqual(0, sub.pending_size)
+
+        # Workers do not keep the connection open.
+        yield nc.close()
+        http = tornado.httpclient.AsyncHTTPClient()
+        for i in range(20):
+            yield tornado.gen.sleep(0.1)
+            response = yield http.fetch(
+                'http://127.0.0.1:%d/connz' % self.server_pool[0].http_port)
+            connz = json.loads(response.body)
+            if connz['num_connections'] == 0:
+                break
+        self.assertEqual(0, connz['num_connections'])
+        pool.close()
+
+    @tornado.testing.gen_test
+    def test_subscribe_batches(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop)
+
+        batches = []
+        pending = []
+
+        @tornado.gen.coroutine
+        def subscription_handler(msgs):
+            pending.append(sub.pending_size)
+            batches.append([msg.data for msg in msgs])
+            yield tornado.gen.sleep(0.1)
+
+        sid = yield nc.subscribe(
+            "tests.>",
+            cb=subscription_handler,
+            batch_size=4,
+            batch_timeout=0.2)
+        sub = nc._subs[sid]
+
+        # Taken in full batches while there are enough pending.
+        for i in range(0, 10):
+            nc.publish_nowait("tests.{0}".format(i), str(i))
+        yield nc.flush()
+        yield tornado.gen.sleep(0.2)
+        self.assertEqual([['0', '1', '2', '3'], ['4', '5', '6', '7']], batches)
+        self.assertEqual([6, 2], pending)
+
+        # The last one waits up to the timeout for more.
+        yield nc.publish("tests.10", "10")
+        yield tornado.gen.sleep(0.1)
+        self.assertEqual(2, len(batches))
+        yield tornado.gen.sleep(0.3)
+        self.assertEqual(['8', '9', '10'], batches[2])
+        self.assertEqual(11, sub.delivered)
+        self.assertEqual(0, sub.pending_size)
+        yield nc.close()
+
+    @tornado.testing.gen_test
+    def test_subscribe_conflicting_options(self):
+        nc = Client()
+        yield nc.connect(io_loop=self.io_loop)
+
+        @tornado.gen.coroutine
+        def handler(msg):
+            pass
+
+        key = lambda msg: msg.subject
+        executor = object()
+        conflicting = [
+            dict(batch_size=10, max_concurrency=2),
+            dict(batch_size=10, executor=executor),
+            dict(batch_size=10, process_pool=ProcessPool(workers=1)),
+            dict(executor=executor, process_pool=ProcessPool(workers=1)),
+            dict(key=key, max_concurrency=2),
+            dict(key=key, is_async=True),
+            dict(max_concurrency=2, is_async=True),
+            dict(result_cb=handler),
+            dict(ordered=True),
+        ]
+        for options in conflicting:
+            with self.assertRaises(ValueError):
+                yield nc.subscribe("foo", cb=handler, **options)
+        with self.assertRaises(ValueError):
+            yield nc.subscribe("foo", future=tornado.concurrent.Future(),
+                               batch_size=10)
+        self.assertEqual(0, len(nc._subs))
+
+        yield nc.subscribe("foo", cb=handler, max_concurrency=2)
+        yield nc.subscribe("foo", cb=handler, key=key, lanes=2)
+        yield nc.subscribe("foo", cb=handler, key=key, executor=executor)
+        yield nc.subscribe_async("foo", cb=handler)
+        self.assertEqual(4, len(nc._subs))
+        yield nc.close()
+
     @tornado.testing.gen_test
     def test_subscribe_async_process_messages_concurrently(self):
         nc = Client()
@@ -1187,9 +2644,12 @@ class ClientTest(tornado.testing.AsyncTestCase):
 
         # We should have received some messages and dropped others,
         # but definitely got the last 3 messages after recovering
-        # from the slow consumer error.
+        # from the slow consumer error.  Messages from a read are
+        # dispatched without yielding, so only the one handed to the
+        # waiting handler plus those which fit in the pending queue
+        # made it through the burst.
         msgs = sub_hello_handler.msgs
-        self.assertEqual(len(msgs), 13)
+        self.assertEqual(len(msgs), 9)
 
         msgs = sub_hello_handler.msgs[-3:]
         for i in range(0, 3):
@@ -2085,6 +3545,37 @@ class LargeControlLineNATSServer(tornado.tcpserver.TCPServer):
                 break
 
 
+class StallingNATSServer(tornado.tcpserver.TCPServer):
+    """
+    Stops reading for a while once the client is connected, so that
+    its writes back up, and then reads everything it sends.
+    """
+
+    def __init__(self, stall=1, **kwargs):
+        super(StallingNATSServer, self).__init__(**kwargs)
+        self.stall = stall
+        self.received = 0
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        info_line = """INFO {"max_payload": 1048576, "tls_required": false, "server_id":"zrPhBhrjbbUdp2vndDIvE7"}\r\n"""
+        stalled = False
+        tail = b''
+        try:
+            yield stream.write(info_line)
+            while True:
+                data = yield stream.read_bytes(65536, partial=True)
+                self.received += len(data)
+                data, tail = tail + data, data[-5:]
+                for i in range(data.count(b'PING\r\n')):
+                    yield stream.write(b'PONG\r\n')
+                if not stalled:
+                    stalled = True
+                    yield tornado.gen.sleep(self.stall)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+
 class ClientConnectTest(tornado.testing.AsyncTestCase):
     def setUp(self):
         print("\n=== RUN {0}.{1}".format(self.__class__.__name__,
@@ -2124,6 +3615,32 @@ class ClientConnectTest(tornado.testing.AsyncTestCase):
         yield nc.connect(**options)
         self.assertTrue(nc.is_connected)
 
+    @tornado.testing.gen_test(timeout=10)
+    def test_flush_after_server_stalls(self):
+        server = StallingNATSServer(io_loop=self.io_loop)
+        server.listen(4229)
+        nc = Client()
+        options = {
+            "dont_randomize": True,
+            "servers": ["nats://127.0.0.1:4229"],
+            "io_loop": self.io_loop,
+            "verbose": False,
+            "max_inflight_bytes": 64 * 1024,
+        }
+        yield nc.connect(**options)
+
+        # Far more than the socket takes while the server is not reading,
+        # so the flusher waits for writes to complete.
+        payload = b'A' * 65536
+        for i in range(0, 64):
+            yield nc.publish("foo", payload)
+        yield nc.flush(timeout=5)
+        self.assertTrue(server.received > 64 * len(payload))
+        self.assertEqual(0, len(nc._inflight))
+        self.assertEqual(0, nc._pending_size)
+        yield nc.close()
+        server.stop()
+
 
 class ClientClusteringDiscoveryTest(tornado.testing.AsyncTestCase):
     def setUp(self):
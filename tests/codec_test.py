@@ -0,0 +1,57 @@
+# Copyright 2018 The NATS Authors
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import sys
+import json
+import unittest
+from nats.io.codec import ZlibCodec, CODEC_PREFIX, CODEC_ZLIB
+
+
+class ZlibCodecTest(unittest.TestCase):
+    def setUp(self):
+        print("\n=== RUN {0}.{1}".format(self.__class__.__name__,
+                                         self._testMethodName))
+        super(ZlibCodecTest, self).setUp()
+
+    def test_compresses_large_payloads(self):
+        codec = ZlibCodec(threshold=64)
+        payload = json.dumps([{"id": i, "event": "created"} for i in range(100)])
+        data = codec.encode(payload)
+        self.assertTrue(data.startswith(CODEC_PREFIX + CODEC_ZLIB))
+        self.assertTrue(len(data) < len(payload))
+        self.assertEqual(payload, codec.decode(data))
+        self.assertEqual(payload, codec.decode(memoryview(data)))
+
+    def test_skips_small_payloads(self):
+        codec = ZlibCodec(threshold=64)
+        payload = b'a' * 63
+        self.assertEqual(payload, codec.encode(payload))
+        self.assertEqual(payload, codec.decode(payload))
+
+    def test_skips_incompressible_payloads(self):
+        codec = ZlibCodec(threshold=8)
+        payload = b'\x8c\x1f\xe2\x05\x9a\x77\x31\xd4\x6b\x10'
+        self.assertEqual(payload, codec.encode(payload))
+
+    def test_frames_raw_payloads_which_look_encoded(self):
+        codec = ZlibCodec()
+        payload = CODEC_PREFIX + b'hello'
+        data = codec.encode(payload)
+        self.assertNotEqual(payload, data)
+        self.assertEqual(payload, codec.decode(data))
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(stream=sys.stdout)
+    unittest.main(verbosity=2, exit=False, testRunner=runner)
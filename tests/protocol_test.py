@@ -32,9 +32,17 @@ class MockNatsClient:
         pass
 
     @tornado.gen.coroutine
-    def _process_msg(self, sid, subject, reply, payload):
+    def _process_msg(self, sid, subject, reply, payload, chunk=None):
         sub = self._subs[sid]
 
+    def _process_msgs(self, batch):
+        for sid, msgs in batch.items():
+            for subject, reply, payload, chunk in msgs:
+                if chunk is None:
+                    self._process_msg(sid, subject, reply, payload)
+                else:
+                    self._process_msg(sid, subject, reply, payload, chunk)
+
     @tornado.gen.coroutine
     def _process_err(self, err=None):
         pass
@@ -157,6 +165,193 @@ class ProtocolParserTest(tornado.testing.AsyncTestCase):
         self.assertEqual(len(ps.buf), 0)
         self.assertEqual(ps.state, AWAITING_CONTROL_LINE)
 
+    @tornado.testing.gen_test
+    def test_parse_err_message(self):
+        nc = MockNatsClient()
+        errors = []
+
+        @tornado.gen.coroutine
+        def process_err(err=None):
+            errors.append(err)
+
+        nc._process_err = process_err
+        for use_regex in (False, True):
+            ps = Parser(nc, use_regex=use_regex)
+            yield ps.parse(b"-ERR 'Slow Consumer'\r\n")
+            self.assertEqual(len(ps.buf), 0)
+        self.assertEqual(errors, ["'Slow Consumer'", "'Slow Consumer'"])
+
+    @tornado.testing.gen_test
+    def test_parse_msg_with_regex(self):
+        nc = MockNatsClient()
+        nc._subs[1] = Subscription(subject="hello")
+        ps = Parser(nc, use_regex=True)
+        data = b'MSG hello 1 world 12\r\n'
+        yield ps.parse(data)
+        self.assertEqual(len(ps.buf), 0)
+        self.assertEqual(ps.msg_arg["subject"], "hello")
+        self.assertEqual(ps.msg_arg["reply"], "world")
+        self.assertEqual(ps.msg_arg["sid"], 1)
+        self.assertEqual(ps.needed, 12)
+        self.assertEqual(ps.state, AWAITING_MSG_PAYLOAD)
+
+        yield ps.parse(b'hello world!\r\n')
+        self.assertEqual(len(ps.buf), 0)
+        self.assertEqual(ps.state, AWAITING_CONTROL_LINE)
+
+    @tornado.testing.gen_test
+    def test_parse_multiple_ops(self):
+        nc = MockNatsClient()
+        msgs = []
+
+        @tornado.gen.coroutine
+        def process_msg(sid, subject, reply, payload):
+            msgs.append((sid, subject, reply, payload))
+
+        nc._process_msg = process_msg
+        ps = Parser(nc)
+        data = b'PING\r\nMSG foo 1 3\r\nabc\r\n+OK\r\nMSG\tbar  2 inbox 0\r\n\r\nPONG\r\n'
+        yield ps.parse(data)
+        self.assertEqual(len(ps.buf), 0)
+        self.assertEqual(ps.state, AWAITING_CONTROL_LINE)
+        self.assertEqual(msgs, [(1, "foo", "", "abc"), (2, "bar", "inbox", "")])
+
+    @tornado.testing.gen_test
+    def test_parse_keeps_partial_op_after_chunk(self):
+        nc = MockNatsClient()
+        nc._subs[1] = Subscription(subject="foo")
+        for use_regex in (False, True):
+            ps = Parser(nc, use_regex=use_regex)
+            data = b'MSG foo 1 3\r\nabc\r\nPING\r\nMSG foo 1 5\r\nhel'
+            yield ps.parse(data)
+            self.assertEqual(ps.pos, 0)
+            self.assertEqual(ps.buf, b'hel')
+            self.assertEqual(ps.state, AWAITING_MSG_PAYLOAD)
+
+            yield ps.parse(b'lo\r\nPO')
+            self.assertEqual(ps.pos, 0)
+            self.assertEqual(ps.buf, b'PO')
+            self.assertEqual(ps.state, AWAITING_CONTROL_LINE)
+
+    @tornado.testing.gen_test
+    def test_parse_msg_into_pooled_chunk(self):
+        nc = MockNatsClient()
+        msgs = []
+
+        @tornado.gen.coroutine
+        def process_msg(sid, subject, reply, payload, chunk=None):
+            msgs.append(payload.tobytes())
+            self.assertTrue(payload.readonly)
+            pool.release(chunk)
+
+        nc._process_msg = process_msg
+        pool = ChunkPool()
+        ps = Parser(nc, pool=pool)
+        payload = b'A' * 1000 + b'B' * 1000
+        yield ps.parse(b'MSG foo 1 2000\r\n' + payload[:500])
+        self.assertEqual(len(ps.buf), 0)
+        self.assertEqual(ps.filled, 500)
+        yield ps.parse(payload[500:])
+        self.assertEqual(ps.state, AWAITING_MSG_PAYLOAD)
+        yield ps.parse(b'\r\nMSG foo 1 3\r\nabc\r\n')
+        self.assertEqual(ps.state, AWAITING_CONTROL_LINE)
+        self.assertEqual(len(ps.buf), 0)
+        self.assertEqual(msgs, [payload, b'abc'])
+
+        # Chunks are reused once released.
+        self.assertEqual(1, len(pool._free[2048]))
+        chunk = pool.acquire(1025)
+        self.assertEqual(0, len(pool._free[2048]))
+        self.assertEqual(2048, len(chunk))
+
+    @tornado.testing.gen_test
+    def test_parse_msgs_batched_by_sid(self):
+        nc = MockNatsClient()
+        ops = []
+
+        def process_msgs(batch):
+            ops.append(dict((sid, [m[2] for m in msgs])
+                            for sid, msgs in batch.items()))
+
+        def process_pong():
+            ops.append('PONG')
+
+        nc._process_msgs = process_msgs
+        nc._process_pong = process_pong
+        ps = Parser(nc)
+        data = b''.join([
+            b'MSG foo 1 1\r\na\r\n',
+            b'MSG bar 2 1\r\nb\r\n',
+            b'MSG foo 1 1\r\nc\r\n',
+            b'PONG\r\n',
+            b'MSG foo 1 1\r\nd\r\n',
+            b'MSG foo 1 1\r\ne',
+        ])
+        yield ps.parse(data)
+        self.assertEqual(ops, [{1: ['a', 'c'], 2: ['b']}, 'PONG', {1: ['d']}])
+        yield ps.parse(b'\r\n')
+        self.assertEqual(ops[-1], {1: ['e']})
+        self.assertEqual(len(ps.batch), 0)
+
+    @tornado.testing.gen_test
+    def test_parse_msg_streamed(self):
+        nc = MockNatsClient()
+        events = []
+
+        def process_stream_start(sid, subject, reply, size):
+            events.append(('start', sid, subject, reply, size))
+
+        def process_stream_data(data):
+            events.append(('data', data))
+
+        def process_stream_end():
+            events.append(('end', ))
+
+        def process_msg(sid, subject, reply, payload, chunk=None):
+            events.append(('msg', sid, payload))
+
+        nc._process_stream_start = process_stream_start
+        nc._process_stream_data = process_stream_data
+        nc._process_stream_end = process_stream_end
+        nc._process_msg = process_msg
+        ps = Parser(nc)
+        ps.streams.add(2)
+
+        payload = b'A' * 1000 + b'B' * 1000
+        yield ps.parse(b'MSG foo 1 1\r\na\r\nMSG bar 2 INBOX 2000\r\n' +
+                       payload[:500])
+        self.assertEqual(ps.state, STREAMING_MSG_PAYLOAD)
+        self.assertEqual(len(ps.buf), 0)
+        yield ps.parse(payload[500:1500])
+        yield ps.parse(payload[1500:] + b'\r')
+        self.assertEqual(ps.state, STREAMING_MSG_PAYLOAD)
+        yield ps.parse(b'\nMSG bar 2 3\r\nab')
+        yield ps.parse(b'c\r\n')
+        self.assertEqual(ps.state, AWAITING_CONTROL_LINE)
+        self.assertEqual(len(ps.buf), 0)
+        self.assertEqual(events, [
+            ('start', 2, b'bar', b'INBOX', 2000),
+            ('data', payload[:500]),
+            ('msg', 1, b'a'),
+            ('data', payload[500:1500]),
+            ('data', payload[1500:]),
+            ('end', ),
+            ('start', 2, b'bar', b'', 3),
+            ('data', b'ab'),
+            ('data', b'c'),
+            ('end', ),
+        ])
+
+    @tornado.testing.gen_test
+    def test_parse_unknown_protocol(self):
+        ps = Parser(MockNatsClient())
+        with self.assertRaises(ErrProtocol):
+            yield ps.parse(b'HELLO\r\n')
+
+        ps = Parser(MockNatsClient())
+        with self.assertRaises(ErrProtocol):
+            yield ps.parse(b'A' * MAX_CONTROL_LINE_SIZE)
+
     def test_parser_repr(self):
         ps = Parser()
         self.assertEqual(repr(ps), "<nats protocol parser state=1>")
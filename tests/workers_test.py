@@ -0,0 +1,80 @@
+# Copyright 2018 The NATS Authors
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import sys
+import unittest
+import tornado.concurrent
+from nats.io.errors import ErrConnectionClosed
+from nats.io.workers import _Worker
+
+
+class WorkerRingTest(unittest.TestCase):
+    def setUp(self):
+        print("\n=== RUN {0}.{1}".format(self.__class__.__name__,
+                                         self._testMethodName))
+        super(WorkerRingTest, self).setUp()
+
+    def alloc(self, worker, size):
+        offset = worker.alloc(size)
+        if offset is not None:
+            worker.inflight.append((offset, offset + size,
+                                    tornado.concurrent.Future()))
+        return offset
+
+    def test_alloc_in_order(self):
+        worker = _Worker(None, 0, 200)
+        self.assertEqual(0, self.alloc(worker, 100))
+        self.assertEqual(100, self.alloc(worker, 50))
+        self.assertEqual(None, self.alloc(worker, 100))
+        worker.release()
+        self.assertEqual(0, self.alloc(worker, 100))
+        self.assertEqual(None, self.alloc(worker, 1))
+        worker.release()
+        self.assertEqual(100, self.alloc(worker, 50))
+        worker.release()
+        worker.release()
+        self.assertEqual(0, self.alloc(worker, 200))
+
+    def test_alloc_empty_payload_on_full_wrapped_ring(self):
+        worker = _Worker(None, 0, 200)
+        self.assertEqual(0, self.alloc(worker, 100))
+        self.assertEqual(100, self.alloc(worker, 100))
+        worker.release()
+        self.assertEqual(0, self.alloc(worker, 100))
+
+        # The ring is full, there is only room for an empty payload.
+        self.assertEqual(100, self.alloc(worker, 0))
+        self.assertEqual(None, self.alloc(worker, 100))
+        self.assertEqual(None, self.alloc(worker, 1))
+
+        worker.release()
+        self.assertEqual(100, self.alloc(worker, 100))
+        self.assertEqual(None, self.alloc(worker, 1))
+
+    def test_fail_resets_ring(self):
+        worker = _Worker(None, 0, 200)
+        self.assertEqual(0, self.alloc(worker, 150))
+        self.assertEqual(150, self.alloc(worker, 50))
+        worker.release()
+        self.assertEqual(0, self.alloc(worker, 100))
+        futures = [future for _, _, future in worker.inflight]
+        worker.fail(ErrConnectionClosed())
+        for future in futures:
+            self.assertIsInstance(future.exception(), ErrConnectionClosed)
+        self.assertEqual(0, self.alloc(worker, 200))
+
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(stream=sys.stdout)
+    unittest.main(verbosity=2, exit=False, testRunner=runner)